@@ -0,0 +1,56 @@
+"""Benchmark: compression ratio and throughput of the image codecs.
+
+Encodes and decodes a synthetic 6x1024x1024 uint16 shot (shadow, light and dark frames of an absorption image with Poisson noise, twice) with each codec, checks the round trip is lossless and reports the compression ratio and the encode and decode throughput. Codecs that need the optional zstandard package are skipped without it.
+
+Run from the repository root: python benchmarks/codec_throughput.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from benchmarks import synthetic
+from imfittre.helpers import codec
+
+CODECS = ["zlib", "shuffle-zlib", "delta-shuffle-zlib", "zstd", "shuffle-zstd", "delta-shuffle-zstd"]
+REPEATS = 10
+
+
+def shot():
+    shape = (1024, 1024)
+    light = synthetic.gaussian(shape, (500, 520), (400, 350), 3000)
+    od = synthetic.gaussian(shape, (520, 500), (60, 40), 0.8)
+    return synthetic.shot(shape, od, shots=2, light=light, dark=100, counts=True)
+
+
+def main():
+    image = shot()
+    print("{} {} image, {:.1f} MB".format(image.shape, image.dtype, image.nbytes / 1e6))
+    for name in CODECS:
+        if name.endswith("zstd") and codec.zstandard is None:
+            print("{:20s} skipped, zstandard is not installed".format(name))
+            continue
+        start = time.perf_counter()
+        data, sizes = codec.encode(image, name)
+        encode_time = time.perf_counter() - start
+
+        out = np.empty_like(image)
+        codec.decode(data, image.dtype.str, image.shape, name, sizes, out=out)
+        assert np.array_equal(out, image), name
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            codec.decode(data, image.dtype.str, image.shape, name, sizes, out=out)
+        decode_time = (time.perf_counter() - start) / REPEATS
+
+        print(
+            "{:20s} ratio {:.2f}, encode {:5.0f} MB/s, decode {:5.0f} MB/s".format(
+                name, image.nbytes / len(data), image.nbytes / encode_time / 1e6, image.nbytes / decode_time / 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Regression check: the InfluxDB writer retries, spills and replays points.
+
+Runs an InfluxWriter against a stub endpoint that can be switched off. While it is off, writes are retried and then spilled to a file, which is only tried again once per replay interval; once it is back, the spilled points are written even if nothing new has been queued, both from the background task and from stop. A replay that fails partway keeps the unwritten points on disk for the next run.
+
+Run from the repository root: python benchmarks/influx_spill.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imfittre.data.influx import InfluxWriter, fit_point
+
+POINTS = 25
+
+
+class Endpoint:
+    """Stands in for an influxdb_client write API, failing while down."""
+
+    def __init__(self):
+        self.up = True
+        self.calls = 0
+        self.points = []
+
+    def write(self, bucket, record):
+        self.calls += 1
+        if not self.up:
+            raise ConnectionError("InfluxDB is down")
+        self.points.extend(record)
+
+
+def points(n, start=0):
+    return [fit_point("|0,0>", {"derived": {"N": i}}) for i in range(start, start + n)]
+
+
+def written(endpoint):
+    return sorted(p["fields"]["N"] for p in endpoint.points)
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        spill_path = os.path.join(directory, "influx.spill")
+
+        # a failed write is retried, then spilled
+        endpoint = Endpoint()
+        endpoint.up = False
+        writer = InfluxWriter(endpoint.write, batch_size=10, flush_interval=0.05, retries=2, backoff=0.01, spill_path=spill_path, replay_interval=0.1)
+        writer.submit(points(POINTS))
+        await writer.flush()
+        assert endpoint.calls == 3, endpoint.calls
+        assert writer.stats()["spilled"] == POINTS and not writer.points, writer.stats()
+        print("ok: retried {} times, then spilled {} points".format(endpoint.calls - 1, POINTS))
+
+        # while InfluxDB stays down and nothing is queued, the spill is only
+        # tried once per replay interval, with a single attempt
+        task = asyncio.ensure_future(writer.run())
+        calls = endpoint.calls
+        await asyncio.sleep(0.35)
+        assert 1 <= endpoint.calls - calls <= 4, endpoint.calls - calls
+        assert writer.stats()["spilled"] == POINTS, writer.stats()
+        print("ok: tried the spill {} times in 0.35 s while down".format(endpoint.calls - calls))
+
+        # once InfluxDB is back, the background task replays the spill without new points
+        endpoint.up = True
+        await asyncio.sleep(0.2)
+        assert written(endpoint) == list(range(POINTS)), written(endpoint)
+        assert not os.path.exists(spill_path) and writer.stats()["spilled"] == 0, writer.stats()
+        await writer.stop()
+        await task
+        print("ok: replayed the spill while idle")
+
+        # a replay that fails partway keeps the rest in the spill file, so that
+        # a restarted writer still has them
+        endpoint = Endpoint()
+        InfluxWriter(endpoint.write, spill_path=spill_path)._spill(points(POINTS))
+        write = endpoint.write
+
+        def fail_after_first(bucket, record):
+            write(bucket, record)
+            endpoint.up = False
+
+        writer = InfluxWriter(fail_after_first, batch_size=10, spill_path=spill_path)
+        await writer.flush()
+        assert written(endpoint) == list(range(10)), written(endpoint)
+        assert writer.stats()["spilled"] == POINTS - 10, writer.stats()
+
+        # stop replays a spill left by an earlier run, with nothing queued
+        endpoint.up = True
+        writer = InfluxWriter(endpoint.write, batch_size=10, spill_path=spill_path)
+        await writer.stop()
+        assert written(endpoint) == list(range(POINTS)), written(endpoint)
+        assert not os.path.exists(spill_path)
+        print("ok: kept the unwritten part of a replay, and replayed it on stop after a restart")
+
+if __name__ == "__main__":
+    asyncio.run(main())
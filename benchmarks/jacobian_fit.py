@@ -0,0 +1,84 @@
+"""Benchmark: Gaussian fits with the analytic Jacobian against finite differences.
+
+Fits the default side-camera Gaussian to a synthetic shot, once with Gaussian.jacobian and once with the Jacobian estimated by 2-point finite differences, and reports the number of evaluations of the fit function (including those made to estimate the Jacobian) and the wall time per fit. Also checks the analytic Jacobian against central differences.
+
+Run from the repository root: python benchmarks/jacobian_fit.py
+"""
+import copy
+import os
+import sys
+import time
+from functools import wraps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from benchmarks import synthetic
+from imfittre import calibrations
+from imfittre.fit.fit_functions import Gaussian
+from imfittre.fit.image_fit import Fit
+
+DATA = {"binning": [1, 1]}
+REPEATS = 20
+
+
+def counted(fit_function):
+    # wraps keeps the signature, from which Fit reads the parameter names
+    @wraps(fit_function)
+    def wrapper(self, *args, **kwargs):
+        type(self).evaluations += 1
+        return fit_function(self, *args, **kwargs)
+
+    return wrapper
+
+
+class Counted(Gaussian):
+    evaluations = 0
+    fit_function = counted(Gaussian.fit_function)
+
+
+class FiniteDifference(Counted):
+    # has_jacobian is False when jacobian is not overridden
+    jacobian = Fit.jacobian
+
+
+def check_jacobian():
+    g = Gaussian(None, DATA, copy.deepcopy(calibrations.default_fit["|0,0>"]))
+    x, y = np.meshgrid(np.arange(210, 290.0), np.arange(320, 360.0))
+    x, y = x.ravel(), y.ravel()
+    params = dict(x0=251.0, y0=341.0, A=1.2, sigmax=15.0, sigmay=6.0, theta=0.3, offset=0.01, gradx=0.001, grady=-0.002)
+    J = g.jacobian(x, y, **params)
+    h = 1e-6
+    for i, name in enumerate(params):
+        up = dict(params, **{name: params[name] + h})
+        down = dict(params, **{name: params[name] - h})
+        numeric = (g.fit_function(x, y, **up) - g.fit_function(x, y, **down)) / (2 * h)
+        assert np.abs(numeric - J[:, i]).max() < 1e-5, name
+    print("ok: analytic Jacobian matches central differences")
+
+
+def main():
+    check_jacobian()
+    image = synthetic.shot(od=synthetic.gaussian((500, 500), (255, 338), (18, 6), 0.8))
+    results = {}
+    for cls in (Counted, FiniteDifference):
+        cls.evaluations = 0
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            f = cls(image, DATA, copy.deepcopy(calibrations.default_fit["|0,0>"]))
+            f.fit()
+            f.post_process()
+        elapsed = (time.perf_counter() - start) / REPEATS
+        results[cls] = f.result["params"]
+        print(
+            "{:18s} {:5.1f} evaluations, {:6.2f} ms per fit".format(
+                "analytic" if cls is Counted else "finite difference", cls.evaluations / REPEATS, elapsed * 1e3
+            )
+        )
+    for name, value in results[Counted].items():
+        assert np.isclose(value, results[FiniteDifference][name], rtol=1e-3, atol=1e-6), name
+
+
+if __name__ == "__main__":
+    main()
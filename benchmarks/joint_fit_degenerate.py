@@ -0,0 +1,68 @@
+"""Regression check: joint fits with a parameter the residuals do not depend on.
+
+With A fixed at 0 in its initial value, or with theta free and sigmax == sigmay, a free parameter has an all-zero Jacobian column. The joint solver (image_fit.fit_group) must still fit these, as the separate path does, instead of raising LinAlgError and losing every fit of the shot. A group whose joint solve does fail must fall back to separate fits.
+
+Run from the repository root: python benchmarks/joint_fit_degenerate.py
+"""
+import copy
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from benchmarks import synthetic
+from imfittre import calibrations
+from imfittre.fit import image_fit
+
+DATA = {"images": {"Side": {"binning": [1, 1]}}}
+CASES = {
+    "A starts at its lower bound": {"A": [0, 0, 5]},
+    "free theta, round start": {"theta": [0, -1, 1], "sigmax": [10, 1, 30], "sigmay": [10, 1, 30]},
+}
+
+
+def shot(n=2):
+    return {"Side": synthetic.shot(od=synthetic.gaussian((500, 500), (250, 340), (15, 6), 0.5), shots=n)}
+
+
+def config(n=2, joint=True, **params):
+    fits = {}
+    for i in range(n):
+        c = copy.deepcopy(calibrations.default_fit["|0,0>"])
+        c["frames"] = {"shadow": 3 * i, "light": 3 * i + 1, "dark": 3 * i + 2}
+        c["joint"] = joint
+        c["params"].update(params)
+        fits["|{},0>".format(i)] = c
+    return fits
+
+
+def check(result):
+    for name, r in result.items():
+        assert isinstance(r, dict), "{}: {}".format(name, r)
+        assert r["params"]["A"] > 0.3 and abs(r["params"]["x0"] - 250) < 0.5, "{}: {}".format(name, r["params"])
+
+
+def main():
+    image = shot()
+    for name, params in CASES.items():
+        check(image_fit.fit(image, DATA, config(**params)))
+        print("ok:", name)
+
+    # a joint solve that fails falls back to fitting each separately
+    solve = np.linalg.solve
+
+    def singular(*args):
+        raise np.linalg.LinAlgError("Singular matrix")
+
+    np.linalg.solve = singular
+    try:
+        check(image_fit.fit(image, DATA, config()))
+    finally:
+        np.linalg.solve = solve
+    print("ok: fallback after LinAlgError")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Micro-benchmark: ODEngine against the previous calculateOD.
+
+Computes the OD of a small and a full-frame region of a synthetic 6x1024x1024 shot with the float64 implementation calculateOD had before ODEngine, and with the current calculateOD, and reports the time per call and the peak memory allocated by a call. Also times calculate_batch on a stack of shots against a loop over them, and checks that all of them agree.
+
+Run from the repository root: python benchmarks/od_engine.py
+"""
+import copy
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from benchmarks import synthetic
+from imfittre import calibrations
+from imfittre.helpers import image_process as ip
+
+METADATA = {"binning": [1, 1]}
+REGIONS = [(85, 35), (1024, 1024)]
+SHOTS = 20
+
+
+def baseline(image, metadata, config):
+    """calculateOD before ODEngine."""
+    shadow = image[config["frames"]["shadow"]]
+    light = image[config["frames"]["light"]]
+    dark = image[config["frames"]["dark"]]
+    Ceff = config["calibrations"]["csat"]
+    bins = metadata["binning"][0]
+
+    s1 = ip.crop_frame(shadow, config, bins) - ip.crop_frame(dark, config, bins)
+    s2 = ip.crop_frame(light, config, bins) - ip.crop_frame(dark, config, bins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        OD = -np.log(s1 / s2)
+    Ceff *= bins**2
+    ODCorrected = OD + (s2 - s1) / Ceff
+    ODCorrected[np.isnan(ODCorrected)] = 0
+    ODCorrected[np.isinf(ODCorrected)] = 0
+    return ODCorrected
+
+
+def shot(seed=0):
+    # float64, as the unsigned subtraction of the baseline would wrap around
+    image = synthetic.shot((1024, 1024), shots=2, light=3000, dark=100, counts=True, seed=seed).astype(np.float64)
+    # a saturated patch where the shadow equals the dark frame
+    image[0, 500:510, 500:510] = image[2, 500:510, 500:510]
+    return image
+
+
+def config(w, h):
+    c = copy.deepcopy(calibrations.default_fit["|0,0>"])
+    c["region"] = {"xc": 512, "yc": 512, "w": w, "h": h}
+    return c
+
+
+def measure(fn, *args, repeats):
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(*args)
+    elapsed = (time.perf_counter() - start) / repeats
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    image = shot()
+    for w, h in REGIONS:
+        c = config(w, h)
+        difference = np.abs(baseline(image, METADATA, c) - ip.calculateOD(image, METADATA, c)).max()
+        assert difference < 1e-5, difference
+        repeats = 200 if w * h < 1e5 else 10
+        for name, fn in (("baseline", baseline), ("ODEngine", ip.calculateOD)):
+            elapsed, peak = measure(fn, image, METADATA, c, repeats=repeats)
+            print("{}x{} {:9s} {:8.0f} us, peak {:6.2f} MB".format(w, h, name, elapsed * 1e6, peak / 1e6))
+        print("{}x{} max difference {:.1e}".format(w, h, difference))
+
+    c = config(*REGIONS[0])
+    stack = np.stack([shot(seed) for seed in range(SHOTS)])
+    engine = ip.ODEngine()
+    batch = engine.calculate_batch(stack, METADATA, c)
+    assert np.array_equal(batch, engine.calculate_batch(list(stack), METADATA, c))
+    assert np.array_equal(batch, np.stack([engine.calculate(s, METADATA, c) for s in stack]))
+    loop, _ = measure(lambda: [engine.calculate(s, METADATA, c) for s in stack], repeats=50)
+    batched, _ = measure(engine.calculate_batch, stack, METADATA, c, repeats=50)
+    print("{} shots: loop {:.0f} us, calculate_batch {:.0f} us".format(SHOTS, loop * 1e6, batched * 1e6))
+
+
+if __name__ == "__main__":
+    main()
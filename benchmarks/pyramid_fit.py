@@ -0,0 +1,60 @@
+"""Benchmark: coarse-to-fine pyramid fits against direct fits on a large region.
+
+Fits a Gaussian to a 500x400 region of a synthetic shot, starting away from the cloud, directly and with each pyramid of block sizes, checks that the final parameters agree with the direct fit, and reports the time per fit and the number of function evaluations summed over the levels.
+
+Run from the repository root: python benchmarks/pyramid_fit.py
+"""
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from benchmarks import synthetic
+from imfittre import calibrations
+from imfittre.fit.fit_functions import Gaussian
+
+DATA = {"binning": [1, 1]}
+PYRAMIDS = [[], [2], [4, 2], [8, 2]]
+REPEATS = 5
+
+
+def config(pyramid):
+    c = copy.deepcopy(calibrations.default_fit["|0,0>"])
+    c["region"] = {"xc": 500, "yc": 500, "w": 500, "h": 400}
+    c["params"].update(
+        {
+            "x0": [470, 260, 740],
+            "y0": [530, 310, 690],
+            "sigmax": [30, 1, 200],
+            "sigmay": [30, 1, 200],
+        }
+    )
+    c["pyramid"] = pyramid
+    return c
+
+
+def main():
+    shape = (1000, 1000)
+    image = synthetic.shot(shape, synthetic.gaussian(shape, (512, 490), (60, 35), 0.8))
+    direct = None
+    for pyramid in PYRAMIDS:
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            f = Gaussian(image, DATA, config(pyramid))
+            f.fit()
+        elapsed = (time.perf_counter() - start) / REPEATS
+        params = f.result["params"]
+        if direct is None:
+            direct = params
+        for name, value in params.items():
+            assert np.isclose(value, direct[name], rtol=1e-4, atol=1e-5), (pyramid, name, value, direct[name])
+        print("pyramid {:8s} {:7.1f} ms per fit, {:3d} evaluations".format(str(pyramid), elapsed * 1e3, f.result["nfev"]))
+    print("ok: final parameters agree with the direct fit:", {k: round(v, 4) for k, v in direct.items()})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Benchmark: rendering of /frame images against the previous matplotlib path.
+
+Renders synthetic OD images with the sizes and widths /frame is typically asked for, once with the previous array_to_png (plt.imsave to PNG, decoded with PIL, resized and encoded again) and once with the current one (imfittre.helpers.render), and reports renders per second and the size of the output. The rest of a /frame request (loading the shot and computing the OD) is the same on both paths and is left out. Also checks that both paths decode to nearly the same pixels.
+
+Run from the repository root: python benchmarks/render_frame.py
+"""
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from matplotlib import pyplot as plt
+from PIL import Image
+
+from benchmarks import synthetic
+from imfittre.helpers import image_process as ip
+
+# (height, width) of the image and (width, height) it is rendered at
+CASES = [((35, 85), (300, None)), ((400, 500), (None, None)), ((400, 500), (1000, None)), ((400, 500), (730, None))]
+DURATION = 1
+
+
+def baseline(image, max_val=None, min_val=None, cmap="inferno", width=None, height=None):
+    """array_to_png before imfittre.helpers.render."""
+    if max_val is None:
+        max_val = image.max()
+    if min_val is None:
+        min_val = image.min()
+    output = BytesIO()
+    plt.imsave(output, image, cmap=cmap, vmin=min_val, vmax=max_val, format="png")
+    output.seek(0)
+
+    img = Image.open(output)
+    if width is not None and height is not None:
+        img = img.resize((width, height), resample=Image.NEAREST)
+    elif width is not None:
+        img = img.resize((width, img.height * width // img.width), resample=Image.NEAREST)
+    elif height is not None:
+        img = img.resize((img.width * height // img.height, height), resample=Image.NEAREST)
+    output = BytesIO()
+    img.save(output, format="png")
+    output.seek(0)
+    return output
+
+
+def rate(fn):
+    fn()
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        fn()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def pixels(png):
+    return np.asarray(Image.open(png).convert("RGB"))
+
+
+def main():
+    for shape, (width, height) in CASES:
+        image = synthetic.od_image(shape)
+        args = (image, 1.0, -0.1, "inferno", width, height)
+        old, new = pixels(baseline(*args)), pixels(ip.array_to_png(*args))
+        assert old.shape == new.shape, (old.shape, new.shape)
+        mismatch = (old != new).any(axis=-1).mean()
+        assert mismatch < 1e-3, mismatch
+
+        print("{}x{} at width {}, height {}:".format(shape[1], shape[0], width, height))
+        for name, fn in (
+            ("baseline", lambda: baseline(*args)),
+            ("png", lambda: ip.array_to_png(*args)),
+            ("webp", lambda: ip.array_to_png(*args, format="webp")),
+        ):
+            print("  {:8s} {:6.0f} renders/s, {:6.1f} kB".format(name, rate(fn), len(fn().getvalue()) / 1e3))
+        print("  pixels differing from the baseline: {:.1e}".format(mismatch))
+
+
+if __name__ == "__main__":
+    main()
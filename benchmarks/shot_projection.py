@@ -0,0 +1,76 @@
+"""Benchmark: shot document bytes transferred per request, whole document against projection.
+
+Builds a shot document with four fits (configs from imfittre.calibrations, results from fitting a synthetic shot) and METADATA metadata values, and reports the BSON size of the whole document, which every request loaded before load_shot took a projection, against the size of the document MongoDB returns with the projection each request now loads it with. The projections are those of the routes, see imfittre.data.data.frame_projection and imfittre.fit.fit.FIT_PROJECTION.
+
+Needs a MongoDB server, given by the MONGO_URI environment variable (by default mongodb://localhost:27017), in which the scratch database DATABASE is created and dropped.
+
+Run from the repository root: python benchmarks/shot_projection.py
+"""
+import copy
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bson
+from pymongo import MongoClient
+
+from benchmarks import synthetic
+from imfittre import calibrations
+from imfittre.data import data
+from imfittre.fit import fit, image_fit
+
+METADATA = 300
+IMAGE = "|0,0>"
+# The scratch database the document is stored in, dropped afterwards
+DATABASE = "imfittre_shot_projection"
+
+
+def shot_document():
+    config = {}
+    for i, name in enumerate(["|0,0>", "|1,0>", "|0,0> wide", "|1,0> wide"]):
+        c = copy.deepcopy(calibrations.default_fit[name.split()[0]])
+        c["frames"] = {"shadow": 0, "light": 1, "dark": 2}
+        c["camera"] = "Side"
+        config[name] = c
+    data = {"images": {"Side": {"binning": [1, 1]}}}
+    results = image_fit.fit({"Side": synthetic.shot()}, data, config)
+    # stored as plain numbers, without the timing, as fit_shot stores them
+    results = json.loads(json.dumps({k: {f: v for f, v in r.items() if f != "timing"} for k, r in results.items()}, default=float))
+    return {
+        "_id": "2024_01_01_1",
+        "time": 1704067200.0,
+        "images": {"Side": {"imageID": bson.ObjectId(), "binning": [1, 1]}},
+        "fit": {k: {"config": config[k], "result": results[k]} for k in config},
+        "metadata": {"variable_{}".format(i): float(i) for i in range(METADATA)},
+    }
+
+
+def main():
+    doc = shot_document()
+    requests = {
+        "/frame": data.frame_projection(IMAGE),
+        "/frame?show_fit=True": data.frame_projection(IMAGE, True),
+        "/overlay": data.frame_projection(IMAGE, True, images=False),
+        "/array": data.frame_projection(IMAGE),
+        "fit_shot, /fit/batch": fit.FIT_PROJECTION,
+        "/average": fit.AVERAGE_PROJECTION,
+    }
+
+    # the projections are applied by MongoDB itself, in a scratch database
+    client = MongoClient(os.environ.get("MONGO_URI", "mongodb://localhost:27017"), serverSelectionTimeoutMS=5000)
+    db = client[DATABASE]
+    try:
+        db.shots.insert_one(doc)
+        full = len(bson.encode(db.shots.find_one({"_id": doc["_id"]})))
+        print("whole document: {} B".format(full))
+        for name, projection in requests.items():
+            size = len(bson.encode(db.shots.find_one({"_id": doc["_id"]}, projection)))
+            print("{:22s} {:6d} B -> {:6d} B".format(name, full, size))
+    finally:
+        client.drop_database(DATABASE)
+        client.close()
+
+if __name__ == "__main__":
+    main()
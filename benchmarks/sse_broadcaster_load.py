@@ -0,0 +1,84 @@
+"""Load test of the /sse broadcaster with many simulated subscribers.
+
+Subscribes SUBSCRIBERS clients to a Broadcaster, SLOW of which sleep after every event, publishes EVENTS events and reports the delivery latency. Checks that every fast subscriber receives every event, that the slow ones are dropped once their queue fills up, and that a subscriber reconnecting with a Last-Event-ID gets the events it missed replayed.
+
+Run from the repository root: python benchmarks/sse_broadcaster_load.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imfittre.helpers.broadcaster import Broadcaster
+
+SUBSCRIBERS = 1000
+SLOW = 10
+EVENTS = 200
+MAX_QUEUE = 20
+REPLAY = 5
+
+
+def event_id(message):
+    return int(message.split(b"id: ")[1].split(b"\r")[0])
+
+
+async def main():
+    broadcaster = Broadcaster(max_queue=MAX_QUEUE, heartbeat=0.05)
+    published = {}
+    latencies = []
+    received = [0] * SUBSCRIBERS
+
+    async def client(i):
+        async for message in broadcaster.subscribe():
+            if message.startswith(b":"):
+                continue
+            latencies.append(time.perf_counter() - published[event_id(message)])
+            received[i] += 1
+            if i < SLOW:
+                await asyncio.sleep(0.1)
+
+    tasks = [asyncio.create_task(client(i)) for i in range(SUBSCRIBERS)]
+    await asyncio.sleep(0.1)
+    assert broadcaster.stats()["subscribers"] == SUBSCRIBERS
+
+    for k in range(EVENTS):
+        message = broadcaster.publish("shot_{}".format(k))
+        published[message.id] = time.perf_counter()
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(0.2)
+
+    latencies.sort()
+    stats = broadcaster.stats()
+    print("{} subscribers ({} slow), {} events, {} delivered".format(SUBSCRIBERS, SLOW, EVENTS, sum(received)))
+    print(
+        "latency p50 {:.1f} ms, p99 {:.1f} ms".format(
+            latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3
+        )
+    )
+    print(stats)
+    assert all(n == EVENTS for n in received[SLOW:]), "a fast subscriber missed events"
+    assert all(n < EVENTS for n in received[:SLOW]) and stats["dropped"] == SLOW, "slow subscribers were not dropped"
+
+    # a reconnecting subscriber gets the events after its Last-Event-ID
+    last = message.id
+    replayed = []
+
+    async def reconnect():
+        async for replay in broadcaster.subscribe(last_event_id=last - REPLAY):
+            replayed.append(event_id(replay))
+            if len(replayed) == REPLAY:
+                return
+
+    await asyncio.wait_for(reconnect(), 1)
+    assert replayed == list(range(last - REPLAY + 1, last + 1)), replayed
+    print("ok: replayed", len(replayed), "events after Last-Event-ID")
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+"""Synthetic absorption images for the benchmarks and checks."""
+import numpy as np
+
+
+def gaussian(shape, center=None, sigma=None, amplitude=1.0):
+    """Returns a 2D Gaussian, e.g. the OD of a cloud or the profile of the imaging beam.
+
+    Args:
+        shape (tuple of int): The (height, width) of the array.
+        center (tuple of float, optional): The (x, y) center. Defaults to None, in which case the middle of the array is used.
+        sigma (tuple of float, optional): The (x, y) standard deviations. Defaults to None, in which case a fifth of the height is used for both.
+        amplitude (float, optional): The peak value. Defaults to 1.
+
+    Returns:
+        numpy.ndarray: The Gaussian, as float64.
+    """
+    if center is None:
+        center = (shape[1] / 2, shape[0] / 2)
+    if sigma is None:
+        sigma = (shape[0] / 5, shape[0] / 5)
+    y, x = np.mgrid[: shape[0], : shape[1]]
+    return amplitude * np.exp(-0.5 * (((x - center[0]) / sigma[0]) ** 2 + ((y - center[1]) / sigma[1]) ** 2))
+
+
+def od_image(shape, noise=0.05, seed=0, **kwargs):
+    """Returns the OD of a cloud with Gaussian noise, as computed from a shot.
+
+    Args:
+        shape (tuple of int): The (height, width) of the image.
+        noise (float, optional): The standard deviation of the noise. Defaults to 0.05.
+        seed (int, optional): The seed of the noise. Defaults to 0.
+        **kwargs: The center, sigma and amplitude of the cloud, see gaussian.
+
+    Returns:
+        numpy.ndarray: The OD, as float32.
+    """
+    rng = np.random.default_rng(seed)
+    return (gaussian(shape, **kwargs) + noise * rng.standard_normal(shape)).astype(np.float32)
+
+
+def shot(shape=(500, 500), od=None, shots=1, light=1000.0, dark=0.0, noise=10.0, counts=False, seed=0):
+    """Returns the frames of an absorption image: a shadow, light and dark frame for each shot, along the first axis.
+
+    Args:
+        shape (tuple of int): The (height, width) of the frames. Defaults to (500, 500).
+        od (numpy.ndarray, optional): The OD of the cloud. Defaults to None, in which case a Gaussian of amplitude 0.8 in the middle of the frame is used.
+        shots (int, optional): The number of shots. Defaults to 1.
+        light (float or numpy.ndarray, optional): The light level, in counts above the dark level. Defaults to 1000.
+        dark (float, optional): The dark level, in counts. Defaults to 0.
+        noise (float, optional): The standard deviation of the Gaussian noise on the light, and so on the shadow frame. Ignored if counts is True. Defaults to 10.
+        counts (bool, optional): If True, the frames are uint16 counts with shot noise, as read from a camera. Defaults to False, in which case they are float64.
+        seed (int, optional): The seed of the noise. Defaults to 0.
+
+    Returns:
+        numpy.ndarray: The frames, of shape (3 * shots, height, width).
+    """
+    rng = np.random.default_rng(seed)
+    if od is None:
+        od = gaussian(shape, amplitude=0.8)
+    transmission = np.exp(-od)
+
+    if counts:
+        mean = [dark + light * transmission, dark + np.broadcast_to(light, shape), np.full(shape, dark)] * shots
+        return np.stack([rng.poisson(m) for m in mean]).astype(np.uint16)
+
+    image = np.full((3 * shots,) + tuple(shape), float(dark))
+    for i in range(shots):
+        beam = light + rng.normal(0, noise, shape)
+        image[3 * i + 1] += beam
+        image[3 * i] += beam * transmission
+    return image
@@ -1,3 +1,5 @@
+import logging
+
 from quart import Quart
 from quart_mongo import Mongo
 from quart_cors import cors
@@ -14,6 +16,10 @@ async def init_app():
     app = Quart(__name__)
     app = cors(app, allow_origin="*")
     app.config.from_object(Config)
+    logging.basicConfig(
+        level=app.config.get("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
 
     mongo.init_app(app)
     influx_db.init_app(app)
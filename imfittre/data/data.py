@@ -1,9 +1,18 @@
+import json
+from asyncio import to_thread
+from datetime import date, datetime
+from hashlib import blake2b
+from io import BytesIO
+import numpy as np
+from PIL import Image
 from quart import current_app as app
-from quart import Blueprint, request, send_file, abort, make_response
+from quart import Blueprint, Response, request, send_file, abort, make_response
 from motor.motor_asyncio import AsyncIOMotorGridFSBucket
 
 from imfittre import calibrations
 from imfittre.helpers import image_process as ip
+from imfittre.helpers import codec, render
+from imfittre.helpers.cache import products, product_key
 from . import database as db
 
 from .. import mongo
@@ -17,16 +26,51 @@ data_bp = Blueprint(
 async def create_fs():
     global fs
     fs = AsyncIOMotorGridFSBucket(mongo.db)
+    db.image_cache.max_bytes = app.config.get("IMAGE_CACHE_MB", 512) * 2**20
+    render.png_compress_level = app.config.get("PNG_COMPRESS_LEVEL", 1)
+    await db.ensure_indexes(mongo.db)
     # app.add_background_task(watch_shots)
 
+@data_bp.route('/cache')
+async def cache():
+    return {
+        'images': db.image_cache.stats(),
+        'products': products.stats(),
+        'shots': db.shot_cache.stats(),
+    }
+
 @data_bp.route('/shot')
 async def shot():
     require_image = request.args.get('require_image', False)
     shot_id = request.args.get('shot_id', None)
-    return await db.load_shot(mongo.db, shot_id, require_image)
+    # the version is read first, so that a change during the load gives a new
+    # ETag next time rather than the new ETag for the old document now
+    version = db.shot_version(shot_id.replace('-', '_')) if shot_id is not None else None
+    data = await db.load_shot(mongo.db, shot_id, require_image)
+    if version is None:
+        version = db.shot_version(data['_id'])
+
+    response = await make_response(data)
+    if version is None:
+        # without the change stream, changes by other clients go unnoticed
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    # the shot only changes when the change stream (or this server) says so
+    tag = etag('shot', data['_id'], version)
+    cache_control = shot_cache_control(shot_id)
+    if request.if_none_match.contains(tag):
+        return not_modified(tag, cache_control)
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = cache_control
+    return response
 
 @data_bp.route('/frame')
 async def frame():
+    """Renders a frame of a shot as a colormapped image.
+
+    Takes the shot_id, camera, image and type of the frame, max_val, min_val and cmap for its contrast, width and height, and format, "png" or "webp". show_fit=True draws the fit of the image over it; fits, given as a repeated parameter (fits=|0,0>&fits=|1,0>) since fit names contain commas, draws those fits instead. See render_frame.
+    """
     shot_id = request.args.get('shot_id', None)
     camera = request.args.get('camera', None)
     image = request.args.get('image', "|0,0>")
@@ -35,8 +79,14 @@ async def frame():
     min_val = request.args.get('min_val', None)
     cmap = request.args.get('cmap', "inferno")
     show_fit = request.args.get('show_fit', False)
+    # fit names contain commas, e.g. "|0,0>", so several are given as fits=a&fits=b
+    fits = request.args.getlist('fits')
     width = request.args.get('width', None)
     height = request.args.get('height', None)
+    format = request.args.get('format', "png")
+
+    if format not in ("png", "webp"):
+        abort(400, 'Unknown format {}. Expecting "png" or "webp".'.format(format))
 
     if min_val is not None:
         min_val = float(min_val)
@@ -47,26 +97,255 @@ async def frame():
     if height is not None:
         height = int(height)
 
-    images, data = await db.load_images(mongo.db, fs, shot_id, camera)
+    # fits overlays several fits, show_fit just the fit of the image
+    if fits:
+        show_fit = fits
+
+    # only the images and the fits being shown are needed, not the whole shot
+    data = await db.load_shot(mongo.db, shot_id, require_image=True, projection=frame_projection(image, show_fit))
+
+    # the render is determined by its key, so a matching ETag needs no rendering
+    tag = etag(*frame_key(data, image, camera, type, max_val, min_val, cmap, show_fit, width, height, format))
+    cache_control = shot_cache_control(shot_id)
+    if request.if_none_match.contains(tag):
+        return not_modified(tag, cache_control)
+    png = await render_frame(data, image, camera, type, max_val, min_val, cmap, show_fit, width, height, format)
+    response = await send_file(BytesIO(png), mimetype='image/' + format)
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def etag(*parts):
+    """Returns an ETag derived from everything that determines a response.
+
+    Args:
+        *parts: The parts, which must have a deterministic repr.
+
+    Returns:
+        str: The ETag, without quotes.
+    """
+    return blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+def shot_cache_control(shot_id):
+    """Returns the Cache-Control header of a response about a shot.
+
+    Shots from before today are historical and rarely change (only when they are refit), so browsers may reuse responses about them for HISTORICAL_MAX_AGE seconds from the app config without asking. Everything else, including the latest shot when no shot is given, must be revalidated with the ETag on every use, which is cheap.
+
+    Args:
+        shot_id (str): The requested shot, or None for the latest shot.
+
+    Returns:
+        str: The header.
+    """
+    max_age = app.config.get("HISTORICAL_MAX_AGE", 3600)
+    if shot_id is not None and max_age:
+        try:
+            day = datetime.strptime(shot_id.replace('-', '_')[:10], '%Y_%m_%d').date()
+        except ValueError:
+            day = None
+        if day is not None and day < date.today():
+            return 'private, max-age={}'.format(max_age)
+    return 'no-cache'
+
+def not_modified(tag, cache_control):
+    """Returns an empty 304 Not Modified response with the given ETag and Cache-Control header."""
+    response = Response('', status=304)
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+@data_bp.route('/array')
+async def array_data():
+    """Returns the OD or a cropped raw frame of a shot as a binary array, so that clients can apply the contrast and colormap themselves.
+
+    Takes shot_id, camera, image and type as /frame does, and optionally dtype, "float16" or "float32" (defaults to the dtype of the array: float32 for OD, the camera's integer type for raw frames), and codec, a codec of imfittre.helpers.codec to compress the array with (defaults to none). The body is packed by imfittre.helpers.codec.pack; the data of "shuffle-zlib" can be inflated in browsers with DecompressionStream("deflate").
+    """
+    shot_id = request.args.get('shot_id', None)
+    camera = request.args.get('camera', None)
+    image = request.args.get('image', "|0,0>")
+    type = request.args.get('type', "OD")
+    dtype = request.args.get('dtype', None)
+    compression = request.args.get('codec', None)
+
+    if dtype not in (None, "float16", "float32"):
+        abort(400, 'Unknown dtype {}. Expecting "float16" or "float32".'.format(dtype))
+
+    data = await db.load_shot(mongo.db, shot_id, require_image=True, projection=frame_projection(image))
+    if camera is None:
+        camera = list(data["images"].keys())[0]
+    key = product_key('array', data["images"][camera]["imageID"], frame_config(data, image), type, dtype, compression)
+
+    tag = etag(*key)
+    cache_control = shot_cache_control(shot_id)
+    if request.if_none_match.contains(tag):
+        return not_modified(tag, cache_control)
+
+    payload = products.get(key)
+    if payload is None:
+        array = await frame_array(data, image, camera, type)
+        if dtype is not None:
+            array = array.astype(dtype)
+        try:
+            payload = products.put(key, codec.pack(array, compression))
+        except (ValueError, ImportError) as e:
+            # an unknown codec, or delta encoding of a float array
+            abort(400, str(e))
 
+    response = await make_response(payload)
+    response.mimetype = 'application/octet-stream'
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+@data_bp.route('/overlay')
+async def overlay():
+    """Returns the crosshairs of fits, for clients to draw over a frame themselves.
+
+    Takes the shot_id, the image whose region the frame shows, and optionally fits, the fits to draw, given as a repeated parameter (fits=|0,0>&fits=|1,0>) since fit names contain commas, which defaults to the fit of the image. No images are loaded. The response gives the "region" of the frame, see imfittre.helpers.image_process.region_origin, and the crosshair of each fit that has one, see imfittre.helpers.image_process.fit_geometry, with centers relative to the corner of the region.
+    """
+    shot_id = request.args.get('shot_id', None)
+    image = request.args.get('image', "|0,0>")
+    fits = request.args.getlist('fits')
+    names = overlay_names(image, fits or True)
+    data = await db.load_shot(mongo.db, shot_id, projection=frame_projection(image, names, images=False))
+
+    config = frame_config(data, image)
+    if "region" not in config:
+        abort(400, 'The config of {} has no region.'.format(image))
+    origin = ip.region_origin(config)
+
+    geometries = {}
+    for k in names:
+        fit = data.get("fit", {}).get(k)
+        geometry = ip.fit_geometry(fit, origin) if fit else None
+        if geometry is not None:
+            geometries[k] = geometry
+    return {"region": origin, "fits": geometries}
+
+def overlay_names(image, show_fit):
+    """Returns the names of the fits to overlay on a frame.
+
+    Args:
+        image (str): The name of the fit whose config gives the region of the frame.
+        show_fit (bool or list of str): The fits to overlay, or True for the fit of the image.
+
+    Returns:
+        list of str: The names of the fits.
+    """
+    if not show_fit:
+        return []
+    if show_fit is True or isinstance(show_fit, str):
+        return [image]
+    return list(show_fit)
+
+def frame_projection(image, show_fit=False, images=True):
+    """Returns the fields of a shot needed to show a frame of it, as a projection for database.load_shot.
+
+    Args:
+        image (str): The name of the fit whose config gives the region and frames.
+        show_fit (bool or list of str, optional): The fits overlaid on the frame, see overlay_names. Defaults to False.
+        images (bool, optional): Whether the images are needed, i.e. whether the frame itself is shown rather than only the overlays. Defaults to True.
+
+    Returns:
+        list of str: The fields.
+    """
+    projection = ["images"] if images else []
+    projection.append("fit.{}.config".format(image))
+    for k in overlay_names(image, show_fit):
+        projection.append("fit.{}.result".format(k))
+        projection.append("fit.{}.config".format(k))
+    return projection
+
+def frame_config(data, image):
+    """Returns the config giving the region and frames of a fit of a shot, or the default config of the fit."""
     if "fit" in data and image in data["fit"]:
-        config = data["fit"][image]["config"]
-    else:
-        config = calibrations.default_fit[image]
+        return data["fit"][image]["config"]
+    return calibrations.default_fit[image]
 
+async def frame_array(data, image="|0,0>", camera=None, type="OD"):
+    """Returns the OD or a cropped raw frame of a shot, from the cache of products if it has been computed before.
+
+    Args:
+        data (dict): The database entry for the shot.
+        image (str, optional): The name of the fit whose config gives the region and frames. Defaults to "|0,0>".
+        camera (str, optional): The camera. Defaults to None, in which case the first camera is used.
+        type (str, optional): "OD", or the name of a frame in the config, e.g. "shadow". Defaults to "OD".
+
+    Returns:
+        numpy.ndarray: The array, shared with the cache, so it should not be modified.
+    """
+    config = frame_config(data, image)
+    if camera is None:
+        camera = list(data["images"].keys())[0]
+    image_id = data["images"][camera]["imageID"]
+
+    array_key = product_key(type, image_id, config)
+    array = products.get(array_key)
+    if array is None:
+        images = await db.download_images(mongo.db, fs, data, camera)
+        if type == "OD":
+            array = await to_thread(ip.calculateOD, images[camera], data["images"][camera], config)
+        else:
+            frame_num = config["frames"][type]
+            binning = data["images"][camera]["binning"][0]
+            array = ip.crop_frame(images[camera][frame_num], config, binning)
+            array = np.ascontiguousarray(array)
+        products.put(array_key, array)
+    return array
+
+def frame_key(data, image="|0,0>", camera=None, type="OD", max_val=None, min_val=None, cmap="inferno", show_fit=False, width=None, height=None, format="png"):
+    """Returns the key of a render of a frame in the render cache, which determines the render. See render_frame for the arguments.
+
+    Returns:
+        tuple: The key.
+    """
+    config = frame_config(data, image)
     if camera is None:
-        camera = list(images.keys())[0]
+        camera = list(data["images"].keys())[0]
+    image_id = data["images"][camera]["imageID"]
 
-    if type == "OD":
-        array = ip.calculateOD(images[camera], data["images"][camera], config)
-    else:
-        frame_num = config["frames"][type]
-        array = ip.crop_frame(images[camera][frame_num], config)
+    # the rendered image also depends on the fit results that are overlaid, and
+    # on their order, which gives their colors
+    fits = {k: data["fit"][k] for k in overlay_names(image, show_fit) if k in data.get("fit", {})}
+    fit_result = json.dumps([[k, v.get("result")] for k, v in fits.items()]) if fits else None
+    return product_key(
+        format, image_id, config, type, max_val, min_val, cmap, width, height, fit_result
+    )
+
+async def render_frame(data, image="|0,0>", camera=None, type="OD", max_val=None, min_val=None, cmap="inferno", show_fit=False, width=None, height=None, format="png"):
+    """Renders a frame of a shot as an image, reusing cached frames and renders.
+
+    Fit overlays are drawn into the colormapped frame before it is encoded, so the image is encoded once either way. The rendering runs in a worker thread, so that large frames do not hold up the event loop.
+
+    Args:
+        data (dict): The database entry for the shot.
+        image (str, optional): The name of the fit whose config gives the region and frames. Defaults to "|0,0>".
+        camera (str, optional): The camera. Defaults to None, in which case the first camera is used.
+        show_fit (bool or list of str, optional): The names of the fits whose crosshairs to draw, in the colors imfittre.helpers.image_process.OVERLAY_COLORS, or True for the fit of the image. Defaults to False.
+        See the /frame route and imfittre.helpers.image_process.array_to_png for the remaining arguments.
+
+    Returns:
+        bytes: The encoded image, a PNG unless another format is given.
+    """
+    png_key = frame_key(data, image, camera, type, max_val, min_val, cmap, show_fit, width, height, format)
+    png = products.get(png_key)
+    if png is not None:
+        return png
+
+    config = frame_config(data, image)
+    if camera is None:
+        camera = list(data["images"].keys())[0]
+    fits = {k: data["fit"][k] for k in overlay_names(image, show_fit) if k in data.get("fit", {})}
 
-    output = ip.array_to_png(array, max_val, min_val, cmap, width, height)
-    
-    if show_fit:
-        fit = data["fit"][image]
-        output = ip.fit_to_image(fit, background=output)
+    array = await frame_array(data, image, camera, type)
+    binning = data["images"][camera]["binning"][0]
+    output = await to_thread(_render, array, config, binning, list(fits.values()), max_val, min_val, cmap, width, height, format)
+    return products.put(png_key, output)
 
-    return await send_file(output, mimetype='image/png')
+def _render(array, config, binning, fits, max_val, min_val, cmap, width, height, format):
+    indices = render.to_indices(array, max_val, min_val, width, height)
+    if not fits:
+        return render.encode(indices, format, cmap)
+    img = Image.fromarray(render.to_rgb(indices, cmap), "RGB")
+    ip.draw_fits(img, fits, ip.region_origin(config, binning, array.shape))
+    return render.encode(img, format)
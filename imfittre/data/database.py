@@ -1,26 +1,93 @@
 import re
-from io import BytesIO
+import asyncio
+import logging
+import secrets
 import numpy as np
-from async_lru import alru_cache
+import bson
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
 
-async def load_shot(db, id, require_image=False):
+from imfittre.helpers import codec
+from imfittre.helpers.cache import ByteLRUCache, products
+
+logger = logging.getLogger(__name__)
+
+# Raw images downloaded from GridFS, keyed by image id. The size is set from the
+# app config on startup.
+image_cache = ByteLRUCache(512 * 2**20)
+
+# Shot documents loaded by id, keyed by (id, projection). Entries are removed
+# when the shot changes, see invalidate_shot. Only used while the change stream
+# is running, since nothing else reports changes made by other clients.
+shot_cache = ByteLRUCache(16 * 2**20, sizeof=lambda doc: len(bson.encode(doc)))
+
+# The most recent shot and the most recent shot with images, as (time, id), so
+# that the latest shot can be loaded without sorting the collection. Only used
+# while the change stream is running to keep them current (see track_change);
+# None if not yet known.
+latest = {'any': None, 'images': None}
+tracking = False
+# The number of changes track_change has handled, so that a latest shot found
+# by a query is not stored if a change arrived while the query ran
+changes = 0
+
+# The number of times each shot has changed since the change stream was opened,
+# for the ETags of shots (see shot_version). The epoch distinguishes versions
+# from different runs of the server and of the change stream.
+shot_versions = {}
+_epoch = secrets.token_hex(4)
+
+# Downloads in progress, keyed by image id, so that concurrent requests for the
+# same image share one download
+_downloads = {}
+
+def _projection_key(projection):
+    if projection is None:
+        return None
+    if isinstance(projection, dict):
+        return tuple(sorted(projection.items()))
+    return tuple(sorted(projection))
+
+async def load_shot(db, id, require_image=False, projection=None, cache=True):
     """Returns the database entry for a given shot. If no shot is give, returns the most recent shot.
 
+    While the change stream is running, shots requested by id are cached until it reports that they changed, so the returned document should not be modified.
+
     Args:
         db: The database to query.
         id (None or string): The shot to return, in the format YYYY_MM_DD_shotnumber. If None, returns the most recent shot.
         require_image (bool): If True, raises an error if the shot does not have images. If the shot is not specified, the most recent shot with images is returned if True.
+        projection (None, list or dict): The fields to return, as for pymongo's find_one. If None, returns the whole document. "images" must be included if require_image is True.
+        cache (bool): If False, the shot is not added to the shot cache, e.g. for shots that are read once in bulk.
     """
 
     if id is not None:
         id = id.replace('-', '_')
         if not re.match(r'^\d{4}_\d{2}_\d{2}_\d+$', id):
             raise ValueError('Invalid shot format. Expecting YYYY_MM_DD_shotnumber but got {}'.format(id))
-        data = await db.shots.find_one({'_id': id})
-    elif require_image:
-        data = await db.shots.find_one({'images': {'$exists': True}}, sort=[('time', -1)])
+        key = (id, _projection_key(projection))
+        data = shot_cache.get(key) if tracking else None
+        if data is None and not tracking:
+            data = await db.shots.find_one({'_id': id}, projection)
+        elif data is None:
+            version = shot_version(id)
+            data = await db.shots.find_one({'_id': id}, projection)
+            # if the shot changed while it was read, the document may be stale
+            if cache and data is not None and shot_version(id) == version:
+                shot_cache.put(key, data)
     else:
-        data = await db.shots.find_one(sort=[('time', -1)])
+        kind = 'images' if require_image else 'any'
+        if not tracking or latest[kind] is None:
+            query = {'images': {'$exists': True}} if require_image else {}
+            seen = changes
+            newest = await db.shots.find_one(query, {'time': 1}, sort=[('time', -1)])
+            if newest is None:
+                raise ValueError('Shot {} not found.'.format(id))
+            # a change during the query may have made the result stale
+            if changes == seen:
+                latest[kind] = (newest.get('time'), newest['_id'])
+            return await load_shot(db, newest['_id'], require_image, projection, cache)
+        return await load_shot(db, latest[kind][1], require_image, projection, cache)
 
     if data is None:
         raise ValueError('Shot {} not found.'.format(id))
@@ -30,13 +97,14 @@ async def load_shot(db, id, require_image=False):
     
     return data
 
-async def update_shot(db, id, update):
+async def update_shot(db, id, update, projection=None):
     """Updates a shot in the database.
 
     Args:
         db: The database to update.
         id (string): The id of the shot to update, in the format YYYY_MM_DD_shotnumber.
         update (dict): The update to apply to the shot.
+        projection (None, list or dict): The fields of the updated shot to return. If None, returns the whole document.
 
     Returns:
         (dict): The updated shot data.
@@ -44,35 +112,211 @@ async def update_shot(db, id, update):
     if not re.match(r'^\d{4}_\d{2}_\d{2}_\d+$', id):
         raise ValueError('Invalid shot format. Please use YYYY_MM_DD_shotnumber.')
     
-    result = await db.shots.update_one({'_id': id}, {'$set': update})
-    if result.matched_count == 0:
+    data = await db.shots.find_one_and_update({'_id': id}, {'$set': update}, projection, return_document=ReturnDocument.AFTER)
+    if data is None:
         raise ValueError('Shot {} not found.'.format(id))
+    invalidate_shot(id)
     
-    return await db.shots.find_one({'_id': id})
+    return data
+
+def track_change(change):
+    """Updates the shot cache and the latest shots for a change reported by the change stream on the shots collection.
+
+    Args:
+        change (dict): The change event.
+    """
+    global changes
+    changes += 1
+    id = change['documentKey']['_id']
+    invalidate_shot(id)
 
+    doc = change.get('fullDocument', None)
+    fields = []
+    if change['operationType'] == 'update':
+        description = change.get('updateDescription', {})
+        fields = list(description.get('updatedFields', {})) + list(description.get('removedFields', []))
+    moved = any(f.split('.')[0] in ('images', 'time') for f in fields)
 
-@alru_cache(maxsize=32)
-async def download_image(db, fs, image_id):
-    """Downloads an image from the database.
+    for kind, current in latest.items():
+        if current is None:
+            continue
+        if change['operationType'] in ('insert', 'replace') and doc is not None and 'time' in doc:
+            if kind == 'images' and 'images' not in doc:
+                if current[1] == id:
+                    latest[kind] = None
+            elif doc['time'] >= current[0]:
+                latest[kind] = (doc['time'], id)
+            elif current[1] == id:
+                latest[kind] = None
+        elif moved or (current[1] == id and change['operationType'] == 'delete'):
+            # the latest shot may have changed; find it again on the next load
+            latest[kind] = None
+
+async def ensure_indexes(db):
+    """Creates the indexes used to find shots by time, if they do not exist.
+
+    An index that conflicts with an existing one (e.g. one with the same keys but other options) is logged and skipped, so that the server still starts.
+
+    Args:
+        db: The database.
+    """
+    indexes = [
+        # the default name, time_1, so that an existing default index is reused
+        ([('time', 1)], {}),
+        # used to find the most recent shot with images
+        ([('time', -1)], {'name': 'time_with_images', 'partialFilterExpression': {'images': {'$exists': True}}}),
+    ]
+    for keys, options in indexes:
+        try:
+            await db.shots.create_index(keys, **options)
+        except OperationFailure as e:
+            logger.warning("Could not create index %s on shots: %s", options.get('name', keys), e)
+
+def set_tracking(on):
+    """Records whether the change stream on the shots collection is running.
+
+    The shot cache, the latest shots and the shot versions are reset whenever the stream is opened or closed, since changes made while it was not running were missed.
+
+    Args:
+        on (bool): Whether the stream is running.
+    """
+    global tracking, changes, _epoch
+    tracking = on
+    # a latest shot found by a query that spans this is not trusted either
+    changes += 1
+    shot_cache.invalidate()
+    for kind in latest:
+        latest[kind] = None
+    shot_versions.clear()
+    _epoch = secrets.token_hex(4)
+
+def invalidate_shot(id):
+    """Removes a shot from the shot cache and bumps its version. Called when the change stream reports that the shot changed.
+
+    Args:
+        id (string): The id of the shot.
+    """
+    shot_versions[id] = shot_versions.get(id, 0) + 1
+    shot_cache.invalidate(lambda k: k[0] == id)
+
+def shot_version(id):
+    """Returns the version of a shot, which changes whenever the shot is invalidated, i.e. whenever it is updated by this server or the change stream reports a change.
+
+    Args:
+        id (string): The id of the shot.
+
+    Returns:
+        str: The version, or None if the change stream is not running, in which case changes by other clients go unnoticed.
+    """
+    if not tracking:
+        return None
+    return '{}.{}'.format(_epoch, shot_versions.get(id, 0))
+
+
+async def download_image(db, fs, image_id, cache=True):
+    """Downloads an image from the database, or returns it from the image cache.
 
     Args:
         db: The database to query.
         fs: The gridfs to query.
         image_id (string): The id of the image to download.
+        cache (bool): If False, a downloaded image is not added to the image cache, e.g. for images that are used once in bulk.
 
     Returns:
-        (numpy.ndarray): The image as a numpy array.
+        (numpy.ndarray): The image as a numpy array. The array is shared with the cache, so it should not be modified.
     """
-    metadata = await db["fs.files"].find_one({"_id": image_id})
-    dtype = metadata["dtype"]
-    shape = metadata["shape"]
-    
-    with BytesIO() as output:
-        await fs.download_to_stream(image_id, output)
-        output.seek(0)
-        return np.frombuffer(output.read(), dtype=dtype).reshape(shape)
+    image = image_cache.get(image_id)
+    if image is not None:
+        return image
+
+    download = _downloads.get(image_id, None)
+    if download is None and not cache:
+        return await _download_image(db, fs, image_id, cache)
+    if download is None:
+        download = asyncio.ensure_future(_download_image(db, fs, image_id))
+        download.add_done_callback(lambda _: _downloads.pop(image_id, None))
+        _downloads[image_id] = download
+    return await asyncio.shield(download)
 
-async def load_images(db, fs, id, camera=None):
+async def _download_image(db, fs, image_id, cache=True):
+    # Read the chunks straight into the final array (or, for compressed images,
+    # the compressed buffer) instead of assembling the file in a BytesIO and
+    # copying it out
+    grid_out = await fs.open_download_stream(image_id)
+    image = np.empty(grid_out.shape, dtype=grid_out.dtype)
+    compression = getattr(grid_out, 'codec', None)
+    if compression is None:
+        buffer = memoryview(image.reshape(-1).view(np.uint8))
+        if grid_out.length != len(buffer):
+            raise ValueError('Image {} has {} bytes but its shape and dtype require {}.'.format(image_id, grid_out.length, len(buffer)))
+    else:
+        buffer = memoryview(bytearray(grid_out.length))
+
+    position = 0
+    while position < len(buffer):
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            raise ValueError('Image {} ended after {} bytes.'.format(image_id, position))
+        buffer[position:position + len(chunk)] = chunk
+        position += len(chunk)
+
+    if compression is not None:
+        await asyncio.to_thread(codec.decode, buffer, image.dtype, image.shape, compression, grid_out.frame_sizes, image)
+    if not cache:
+        return image
+    return image_cache.put(image_id, image)
+
+async def upload_image(fs, image, filename, compression=None):
+    """Uploads an image to the database.
+
+    Args:
+        fs: The gridfs to upload to.
+        image (numpy.ndarray): The image to upload.
+        filename (string): The filename to store the image under.
+        compression (None or string): The codec to compress the image with, e.g. "shuffle-zstd". See imfittre.helpers.codec. If None, the image is stored uncompressed.
+
+    Returns:
+        The id of the uploaded image.
+    """
+    fields = {'dtype': str(image.dtype), 'shape': list(image.shape)}
+    if compression is None:
+        data = np.ascontiguousarray(image).tobytes()
+    else:
+        data, frame_sizes = await asyncio.to_thread(codec.encode, image, compression)
+        fields.update({'codec': compression, 'frame_sizes': frame_sizes})
+    # the file document fields are stored at the top level, next to length and chunkSize
+    grid_in = fs.open_upload_stream(filename)
+    for k, v in fields.items():
+        await grid_in.set(k, v)
+    await grid_in.write(data)
+    await grid_in.close()
+    return grid_in._id
+
+def invalidate_image(image_id):
+    """Removes an image, and everything derived from it, from the caches.
+
+    Uploads always get a new id, so this is only needed when an image is deleted or rewritten in GridFS under its old id, e.g. by a maintenance script.
+
+    Args:
+        image_id: The id of the image.
+    """
+    image_cache.invalidate(lambda k: k == image_id)
+    products.invalidate(lambda k: k[1] == image_id)
+
+async def prefetch_images(db, fs, shot_data):
+    """Downloads a shot's images into the image cache, ignoring any errors.
+
+    Args:
+        db: The database to query.
+        fs: The gridfs to query.
+        shot_data (dict): The database entry for the shot.
+    """
+    try:
+        await download_images(db, fs, shot_data)
+    except Exception as e:
+        logger.error("Could not prefetch images for shot %s: %s", shot_data.get("_id"), e)
+
+async def load_images(db, fs, id, camera=None, projection=None, cache=True):
     """Returns the images for a given shot. If no shot is give, returns the images from the most recent shot with images.
     
     Args:
@@ -80,15 +324,56 @@ async def load_images(db, fs, id, camera=None):
         fs: The gridfs to query.
         id (None or string): The shot to return, in the format YYYY_MM_DD_shotnumber. If None, returns the most recent shot.
         camera (None or string): The camera whose images to return. If None, returns images from all cameras.
+        projection (None, list or dict): The fields of the shot to return. See load_shot.
+        cache (bool): If False, neither the shot nor its images are added to the caches. See load_shot.
 
     Returns:
         (dict, dict): A tuple of dictionaries. The first dictionary maps camera names to numpy arrays of images. The second dictionary is the database entry for the shot.
 
     """
-    shot_data = await load_shot(db, id, require_image=True)
-        
-    cameras = {}
-    for (k,v) in shot_data["images"].items():
-        if camera is None or camera == k:
-            cameras[k] = await download_image(db, fs, v["imageID"])
-    return cameras, shot_data
\ No newline at end of file
+    shot_data = await load_shot(db, id, require_image=True, projection=projection, cache=cache)
+    return await download_images(db, fs, shot_data, camera, cache), shot_data
+
+async def download_images(db, fs, shot_data, camera=None, cache=True):
+    """Downloads the images referenced by a shot's database entry.
+
+    Args:
+        db: The database to query.
+        fs: The gridfs to query.
+        shot_data (dict): The database entry for the shot. Must have images.
+        camera (None or string): The camera whose images to return. If None, returns images from all cameras.
+        cache (bool): If False, downloaded images are not added to the image cache. See download_image.
+
+    Returns:
+        (dict): A dictionary mapping camera names to numpy arrays of images.
+    """
+    names = [k for k in shot_data["images"] if camera is None or camera == k]
+    images = await asyncio.gather(*(download_image(db, fs, shot_data["images"][k]["imageID"], cache) for k in names))
+    return dict(zip(names, images))
+
+async def shot_query(db, start=None, end=None, date=None):
+    """Builds a query matching the shots with images in a range of shots or on a given date.
+
+    Args:
+        db: The database to query.
+        start (None or string): The first shot to match, in the format YYYY_MM_DD_shotnumber.
+        end (None or string): The last shot to match, in the format YYYY_MM_DD_shotnumber. If None, matches every shot after start.
+        date (None or string): The date whose shots to match, in the format YYYY_MM_DD. Ignored if start is given.
+
+    Returns:
+        (dict): The query.
+    """
+    query = {'images': {'$exists': True}}
+    if start is not None:
+        # Shot numbers are not zero-padded, so the range is taken over time rather than over ids
+        query['time'] = {'$gte': (await load_shot(db, start))['time']}
+        if end is not None:
+            query['time']['$lte'] = (await load_shot(db, end))['time']
+    elif date is not None:
+        date = date.replace('-', '_')
+        if not re.match(r'^\d{4}_\d{2}_\d{2}$', date):
+            raise ValueError('Invalid date format. Expecting YYYY_MM_DD but got {}'.format(date))
+        query['_id'] = {'$regex': '^{}_'.format(date)}
+    else:
+        raise ValueError('Either a start shot or a date must be given.')
+    return query
@@ -0,0 +1,270 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from imfittre.helpers.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# The fields written for each fit, mapping the InfluxDB field name to the
+# dotted path of the value in the fit result
+DEFAULT_FIELDS = {
+    "N": "derived.N",
+    "sigmax_um": "derived.sigmax_um",
+    "sigmay_um": "derived.sigmay_um",
+    "x0_px": "params.x0",
+    "y0_px": "params.y0",
+}
+
+
+def fit_point(name, result, time=None, fields=None):
+    """Converts a fit result to an InfluxDB point.
+
+    Schema:
+        measurement: fit
+        tags: fit name
+        fields: as given by fields. Values missing from the result are None.
+        time: the given time, or the time the point is submitted to an InfluxWriter if None
+
+    Args:
+        name (str): The name of the fit.
+        result (dict): The result of the fit.
+        time (datetime, optional): The time of the point. Defaults to None.
+        fields (dict, optional): Maps field names to dotted paths in the result. Defaults to None, in which case DEFAULT_FIELDS is used.
+
+    Returns:
+        dict: The point.
+    """
+    if fields is None:
+        fields = DEFAULT_FIELDS
+
+    values = {}
+    for field, path in fields.items():
+        value = result
+        for key in path.split("."):
+            value = value.get(key, None) if isinstance(value, dict) else None
+        values[field] = value
+
+    point = {"measurement": "fit", "tags": {"fit": name}, "fields": values}
+    if time is not None:
+        point["time"] = time
+    return point
+
+
+def shot_time(value):
+    """Converts the time of a shot to a timezone-aware datetime, so that a point is stamped the same way whenever the shot is fit.
+
+    Args:
+        value (datetime, float or None): The time of the shot: a datetime, taken to be UTC if naive, or seconds since the epoch.
+
+    Returns:
+        datetime or None: The time, or None if the shot has no time.
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+    return datetime.fromtimestamp(float(value), timezone.utc)
+
+
+class InfluxWriter:
+    """Writes points to InfluxDB in the background, in batches.
+
+    Points are buffered and written when batch_size points are waiting or flush_interval seconds have passed. A failed write is retried with exponential backoff; if it still fails the points are appended to a spill file, which is written out again after the next successful write, or every replay_interval seconds while no points are written. The spill file is only shortened once its points have been written, so a restart during an outage loses nothing; points written just before a restart may be written twice, which InfluxDB treats as an overwrite.
+
+    Args:
+        write (callable): A blocking function taking the keyword arguments bucket and record that writes a list of points, e.g. the write method of an influxdb_client write API. It is run in a worker thread.
+        bucket (str, optional): The bucket to write to. Defaults to "log".
+        batch_size (int, optional): The number of points that triggers a write. Defaults to 500.
+        flush_interval (float, optional): The maximum time in seconds a point waits before being written. Defaults to 1.
+        retries (int, optional): The number of times a failed write is retried. Defaults to 3.
+        backoff (float, optional): The delay in seconds before the first retry, doubled for each further retry. Defaults to 0.5.
+        spill_path (str, optional): The file to store points that could not be written in. Defaults to None, in which case they are dropped.
+        max_points (int, optional): The maximum number of buffered points; the oldest are dropped (and counted) beyond this. Defaults to 100000.
+        replay_interval (float, optional): The time in seconds between attempts to write the spilled points while no new points are written, e.g. while InfluxDB is down. Defaults to 30.
+    """
+
+    def __init__(self, write, bucket="log", batch_size=500, flush_interval=1, retries=3, backoff=0.5, spill_path=None, max_points=100000, replay_interval=30):
+        self.write = write
+        self.bucket = bucket
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.spill_path = spill_path
+        self.replay_interval = replay_interval
+
+        self.points = deque(maxlen=max_points)
+        self.written = 0
+        self.failed = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flush_seconds = 0
+        self.last_flush_seconds = None
+
+        self._wakeup = asyncio.Event()
+        self._stopped = False
+        # so that a flush by stop does not replay the spill alongside one by run
+        self._flushing = asyncio.Lock()
+        # the earliest time to try the spill again without a successful write
+        # first; a spill left by an earlier run is tried right away
+        self._replay_at = 0
+
+    def submit(self, points):
+        """Queues points to be written.
+
+        Points without a time are stamped with the current time, so that they keep it however late they are written, e.g. after being spilled.
+
+        Args:
+            points (iterable of dict): The points.
+        """
+        now = datetime.now(timezone.utc)
+        points = [p if "time" in p else dict(p, time=now) for p in points]
+        overflow = len(self.points) + len(points) - self.points.maxlen
+        if overflow > 0:
+            self.dropped += overflow
+            logger.warning("InfluxDB queue is full; dropping the %d oldest points", overflow)
+        self.points.extend(points)
+        if len(self.points) >= self.batch_size:
+            self._wakeup.set()
+
+    async def run(self):
+        """Writes the queued points until stop is called. Should be run as a background task."""
+        while not self._stopped:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def stop(self):
+        """Stops the background task after writing the queued points."""
+        self._stopped = True
+        self._wakeup.set()
+        await self.flush()
+
+    async def flush(self):
+        """Writes the queued points now, followed by any spilled points if the write succeeds.
+
+        Spilled points are also retried every replay_interval seconds when nothing is queued, so that they are written once InfluxDB recovers even if no new points arrive.
+        """
+        async with self._flushing:
+            await self._flush()
+
+    async def _flush(self):
+        written = False
+        while self.points:
+            batch = [self.points.popleft() for _ in range(min(self.batch_size, len(self.points)))]
+            if not await self._write(batch):
+                # InfluxDB is down, so spill everything rather than retrying each batch
+                self._spill(batch + list(self.points))
+                self.points.clear()
+                self._replay_at = time.monotonic() + self.replay_interval
+                return
+            written = True
+        if self.spill_path is None or not os.path.exists(self.spill_path):
+            return
+        if written or time.monotonic() >= self._replay_at:
+            await self._unspill()
+
+    async def _write(self, batch, retries=None):
+        retries = self.retries if retries is None else retries
+        delay = self.backoff
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.write, bucket=self.bucket, record=batch)
+            except Exception as e:
+                self.failed += 1
+                logger.error("InfluxDB write of %d points failed: %s", len(batch), e)
+                if attempt < retries and not self._stopped:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+                continue
+            self.last_flush_seconds = time.perf_counter() - start
+            metrics.observe("influx_write_seconds", self.last_flush_seconds)
+            self.flush_seconds += self.last_flush_seconds
+            self.flushes += 1
+            self.written += len(batch)
+            return True
+        return False
+
+    def _spill(self, batch):
+        if self.spill_path is None or not batch:
+            return
+        with open(self.spill_path, "a") as f:
+            for point in batch:
+                f.write(json.dumps(point, default=_encode) + "\n")
+        self.spilled += len(batch)
+
+    async def _unspill(self):
+        # Write the spilled points back in batches, then drop the ones written
+        # from the file, keeping any appended meanwhile. The file is left as it
+        # is until then, so that the points survive a restart.
+        with open(self.spill_path, "rb") as f:
+            lines = f.read().splitlines()
+            end = f.tell()
+        lines = [line.rstrip() + b"\n" for line in lines if _readable(line)]
+        sent = 0
+        for i in range(0, len(lines), self.batch_size):
+            batch = [json.loads(line) for line in lines[i:i + self.batch_size]]
+            # a single attempt, since a failure most likely means InfluxDB is still down
+            if not await self._write(batch, retries=0):
+                break
+            sent = i + len(batch)
+        if sent == 0 and lines:
+            self._replay_at = time.monotonic() + self.replay_interval
+            return
+
+        with open(self.spill_path, "rb") as f:
+            f.seek(end)
+            remaining = lines[sent:] + [line.rstrip() + b"\n" for line in f.read().splitlines() if _readable(line)]
+        if remaining:
+            self._replay_at = time.monotonic() + self.replay_interval
+            spill = self.spill_path + ".tmp"
+            with open(spill, "wb") as f:
+                f.writelines(remaining)
+            os.replace(spill, self.spill_path)
+        else:
+            os.remove(self.spill_path)
+        self.spilled = len(remaining)
+
+    def stats(self):
+        """Returns the queue depth and write statistics.
+
+        Returns:
+            dict: The number of queued and spilled points, the numbers of points written, dropped from a full queue and writes failed, and the mean and last write latency in seconds.
+        """
+        return {
+            "queued": len(self.points),
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed_writes": self.failed,
+            "mean_flush_seconds": self.flush_seconds / self.flushes if self.flushes else None,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+
+def _readable(line):
+    # skips blank lines and any line cut short, e.g. by a crash while spilling
+    if not line.strip():
+        return False
+    try:
+        json.loads(line)
+    except ValueError:
+        logger.warning("Skipping an unreadable line of the InfluxDB spill file")
+        return False
+    return True
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return float(value)
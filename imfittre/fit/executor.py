@@ -0,0 +1,62 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+
+class FitExecutor:
+    """Runs CPU-bound fitting work off the event loop.
+
+    Fits are submitted to a process or thread pool and awaited, so the webserver stays responsive while scipy runs and several shots can be fit in parallel. The number of fits that are queued or running at once is bounded; further submissions wait for a free slot.
+
+    Worker processes are started by a fork server (or spawned where there is none) rather than forked from the server, which by the first fit is running the event loop and the threads of pymongo and the thread pools, and could deadlock in a forked child. Such workers import the main module of the server as __mp_main__, so a script that starts the server must not build the app at module level when imported under that name, as wsgi.py does.
+
+    Args:
+        kind (str, optional): Either "process" or "thread". Defaults to "process".
+        max_workers (int, optional): The number of workers in the pool. Defaults to None, in which case the number of CPUs is used.
+        max_pending (int, optional): The maximum number of fits queued or running at once. Defaults to None, in which case twice the number of workers is used.
+    """
+
+    def __init__(self, kind="process", max_workers=None, max_pending=None):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.max_workers = max_workers
+
+        if kind == "process":
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            context = multiprocessing.get_context(method)
+            if method == "forkserver":
+                # import the fitting code once in the server rather than in every worker
+                context.set_forkserver_preload(["imfittre.fit.image_fit"])
+            self.pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+        elif kind == "thread":
+            self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            raise ValueError(
+                'Invalid executor kind. Expecting "process" or "thread" but got {}'.format(kind)
+            )
+
+        if max_pending is None:
+            max_pending = 2 * max_workers
+        self.max_pending = max_pending
+        self._slots = asyncio.Semaphore(max_pending)
+
+    async def submit(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) in the pool and returns its result, waiting for a free slot first if the queue is full.
+
+        Args:
+            fn (callable): The function to run. Must be picklable when using a process pool.
+            *args: The arguments to pass to fn.
+            **kwargs: The keyword arguments to pass to fn.
+
+        Returns:
+            The return value of fn.
+        """
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        """Shuts down the pool, cancelling any fits that have not started."""
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -2,65 +2,152 @@ from quart import Blueprint, request, abort, make_response
 from quart import current_app as app
 from motor.motor_asyncio import AsyncIOMotorGridFSBucket
 from influxdb_client.client.write_api import SYNCHRONOUS
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 
 from imfittre.fit import image_fit as imfit
+from imfittre.fit.executor import FitExecutor
 from imfittre import calibrations
 from imfittre.data import database as db
-from imfittre.helpers.server_sent_events import ServerSentEvent
+from imfittre.data import influx
+from imfittre.data.data import render_frame, frame_config
+from imfittre.helpers.broadcaster import Broadcaster
+from imfittre.helpers import codec, image_process as ip
+from imfittre.helpers.cache import products, product_key
+from imfittre.helpers.metrics import metrics, COUNT_BUCKETS
 
 
-from asyncio import sleep
+from asyncio import wait, create_task, to_thread, FIRST_COMPLETED
+from functools import partial
+from time import monotonic, perf_counter
+from uuid import uuid4
+import json
+import logging
+from urllib.parse import urlencode
+import numpy as np
 
 from .. import mongo, influx_db
 
 fit_bp = Blueprint("fit_bp", __name__)
 
-sse_queue = []
+logger = logging.getLogger(__name__)
+
+metrics.describe("shot_stage_seconds", "Time taken by each stage of fitting a shot.")
+metrics.describe("shot_seconds", "Time taken to fit a shot, from loading it to publishing the results.")
+metrics.describe("fit_stage_seconds", "Time taken by each stage of a fit, in the fit worker.")
+metrics.describe("fit_nfev", "Function evaluations per fit.")
+metrics.describe("fit_njev", "Jacobian evaluations per fit.")
+metrics.describe("fits_total", "Fits run, by fit name and solver status.")
+
+broadcaster = Broadcaster()
+
+# The most recent successful fit parameters, keyed by (fit name, camera), used
+# to warm-start fits whose config sets "warm_start" to "previous"
+last_params = {}
+
+# The image downloads started ahead of the fits of new shots, kept so that they
+# are not garbage-collected before they finish
+prefetches = set()
+
+# The fields of a shot loaded to fit it, and to average it with others
+FIT_PROJECTION = ["images", "fit", "time"]
+AVERAGE_PROJECTION = ["images"]
+
+# The statuses of fits that converged
+CONVERGED = {imfit.STATUS_DICT[status] for status in (1, 2, 3, 4)} | {
+    imfit.LM_STATUS_DICT[status] for status in (2, 3)
+}
+
+
+def log_failure(shot_id, task):
+    """Logs the exception of a finished task fitting a shot, if it failed."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Could not fit shot %s", shot_id, exc_info=task.exception())
 
 
 async def watch_shots():
-    """Watches the database for new shots and updates the list of shots."""
+    """Watches the database for new shots and updates the list of shots.
+
+    Every change to a shot is passed to database.track_change to keep the shot cache and the latest shots current; shots that are replaced with a version that has images are fit.
+    """
 
-    # TODO: This should be an update operation, but it seems it is a replace in the change stream. This works for now, but we should figure out why.
     pipeline = [
         {
             "$match": {
-                "$and": [
-                    {"operationType": "replace"},
-                    {"fullDocument.images": {"$exists": True}},
-                ]
+                "operationType": {"$in": ["insert", "update", "replace", "delete"]}
             }
         }
     ]
+    # fit shots concurrently, but never have more in flight than the executor
+    # will accept, so that a burst of shots does not pile up unbounded tasks
+    pending = set()
     async with mongo.db.shots.watch(pipeline) as stream:
-        async for change in stream:
-            shot_id = change["documentKey"]["_id"]
-            print("Fitting shot {}".format(shot_id))
-            await fit_shot(shot_id, update_db=True)
+        # the cached shots and latest shot pointers are only trustworthy while
+        # the stream runs, and those found before it was opened may have missed
+        # changes
+        db.set_tracking(True)
+        try:
+            async for change in stream:
+                shot_id = change["documentKey"]["_id"]
+                db.track_change(change)
+
+                # TODO: This should be an update operation, but it seems it is a replace in the change stream. This works for now, but we should figure out why.
+                if change["operationType"] != "replace" or "images" not in change["fullDocument"]:
+                    continue
+
+                # start downloading the images right away, so that they are cached
+                # for the fit and for the first /frame request
+                prefetch = create_task(db.prefetch_images(mongo.db, fs, change["fullDocument"]))
+                prefetches.add(prefetch)
+                prefetch.add_done_callback(prefetches.discard)
+                logger.info("Fitting shot %s", shot_id)
+                if len(pending) >= executor.max_pending:
+                    _, pending = await wait(pending, return_when=FIRST_COMPLETED)
+                task = create_task(fit_shot(shot_id, update_db=True))
+                task.add_done_callback(partial(log_failure, shot_id))
+                pending.add(task)
+        finally:
+            db.set_tracking(False)
 
 
 @fit_bp.before_app_serving
 async def create_fs():
-    global fs
+    global fs, executor, influx_writer, influx_fields
     fs = AsyncIOMotorGridFSBucket(mongo.db)
+    products.max_bytes = app.config.get("PRODUCT_CACHE_MB", 256) * 2**20
+    executor = FitExecutor(
+        app.config.get("FIT_EXECUTOR", "process"),
+        app.config.get("FIT_WORKERS", None),
+        app.config.get("FIT_MAX_PENDING", None),
+    )
+    influx_fields = app.config.get("INFLUX_FIELDS", None)
+    write_api = influx_db.connection.write_api(write_options=SYNCHRONOUS)
+    influx_writer = influx.InfluxWriter(
+        write_api.write,
+        bucket=app.config.get("INFLUX_BUCKET", "log"),
+        batch_size=app.config.get("INFLUX_BATCH_SIZE", 500),
+        flush_interval=app.config.get("INFLUX_FLUSH_INTERVAL", 1),
+        spill_path=app.config.get("INFLUX_SPILL_PATH", None),
+        replay_interval=app.config.get("INFLUX_REPLAY_INTERVAL", 30),
+    )
+    app.add_background_task(influx_writer.run)
     app.add_background_task(watch_shots)
 
 
+@fit_bp.after_app_serving
+async def shutdown_executor():
+    executor.shutdown()
+    await influx_writer.stop()
+
+
 @fit_bp.route("/sse")
 async def sse():
     if "text/event-stream" not in request.accept_mimetypes:
         abort(400)
 
-    async def send_events():
-        while True:
-            while len(sse_queue) > 0:
-                data = sse_queue.pop(0)
-                event = ServerSentEvent(data)
-                yield event.encode()
-            await sleep(0.5)
-
+    last_event_id = request.headers.get("Last-Event-ID", None)
     response = await make_response(
-        send_events(),
+        broadcaster.subscribe(last_event_id),
         {
             "Content-Type": "text/event-stream",
             "Cache-Control": "no-cache",
@@ -72,71 +159,195 @@ async def sse():
 
 
 async def fit_shot(shot_id, update_db=False):
-    images, data = await db.load_images(mongo.db, fs, shot_id)
+    # the time taken by each stage, in seconds
+    timing = {}
+    start = perf_counter()
+    with metrics.timer("shot_stage_seconds", stage="load_shot") as elapsed:
+        data = await db.load_shot(mongo.db, shot_id, require_image=True, projection=FIT_PROJECTION)
+    timing["load_shot"] = elapsed["seconds"]
+    with metrics.timer("shot_stage_seconds", stage="download") as elapsed:
+        images = await db.download_images(mongo.db, fs, data)
+    timing["download"] = elapsed["seconds"]
+
     config = {}
     for k in data.get("fit", {}):
         config[k] = data["fit"][k]["config"]
-    result = imfit.fit(images, data, config)
+    seeds = {k: last_params.get((k, v.get("camera"))) for k, v in config.items()}
+
+    if update_db and any(v.get("mode") == "fast-then-full" for v in config.values()):
+        # announce the fast results before running the full fits
+        with metrics.timer("shot_stage_seconds", stage="fast") as elapsed:
+            fast, frames = await executor.submit(
+                imfit.fit, images, data, config, seeds, True, "fast"
+            )
+        timing["fast"] = elapsed["seconds"]
+        event = {"shot_id": data["_id"], "fits": {k: fit_summary(v) for k, v in fast.items()}}
+        broadcaster.publish(json.dumps(event), event="fast")
+        # the full stage fits the frames the fast stage already computed
+        with metrics.timer("shot_stage_seconds", stage="fit") as elapsed:
+            full, full_frames = await executor.submit(
+                imfit.fit, images, data, config, seeds, True, "full", cropped=frames
+            )
+        result = {k: full[k] if k in full else fast[k] for k in config}
+        frames.update(full_frames)
+    else:
+        with metrics.timer("shot_stage_seconds", stage="fit") as elapsed:
+            result, frames = await executor.submit(
+                imfit.fit, images, data, config, seeds, True
+            )
+    timing["fit"] = elapsed["seconds"]
+    record_fits(result)
+
+    # keep the frames the fitter computed so that /frame does not recompute them
+    for k, frame in frames.items():
+        image_id = data["images"][config[k]["camera"]]["imageID"]
+        key = product_key(config[k].get("frame", "OD"), image_id, config[k])
+        products.put(key, frame)
+
+    # only seed later fits from converged full fits of shots being recorded, not
+    # from fast results or ad hoc refits of old shots
+    if update_db:
+        for k, v in result.items():
+            if isinstance(v, dict) and "params" in v and v.get("mode") != "fast" and v.get("status") in CONVERGED:
+                last_params[(k, config[k].get("camera"))] = v["params"]
 
     shot_id = data["_id"]
+    point_time = influx.shot_time(data.get("time"))
 
     if update_db:
         # only replace the fit."name".result subdocument
-        update = {"fit.{}.result".format(k): v for k, v in result.items()}
-        await db.update_shot(mongo.db, shot_id, update)
+        update = {"fit.{}.result".format(k): stored_result(v) for k, v in result.items()}
+        with metrics.timer("shot_stage_seconds", stage="update") as elapsed:
+            data = await db.update_shot(
+                mongo.db, shot_id, update, projection=["images", "fit"]
+            )
+        timing["update"] = elapsed["seconds"]
 
-        # also update influxdb
-        # schema:
-        #   bucket: log
-        #   measurement: fit
-        #   tags: fit name
-        #   fields: derived.n, derived.sigmax_um, derived.sigmay_um, params.x0, params.y0
-        #   time: now
+        # also update influxdb; the points are written in the background, see
+        # the influx_write_seconds metric. They are stamped with the time of the
+        # shot, so that a refit overwrites them.
+        influx_writer.submit(
+            influx.fit_point(k, v, point_time, influx_fields)
+            for k, v in result.items()
+            if isinstance(v, dict)
+        )
 
-        for k, v in result.items():
+        with metrics.timer("shot_stage_seconds", stage="publish") as elapsed:
+            broadcaster.publish(json.dumps(await shot_event(data, result)))
+        timing["publish"] = elapsed["seconds"]
+
+    total = perf_counter() - start
+    metrics.observe("shot_seconds", total)
+    if total > app.config.get("FIT_SLOW_SECONDS", 2):
+        logger.warning(
+            "Shot %s took %.2f s to fit (%s)",
+            shot_id,
+            total,
+            ", ".join("{} {:.3f} s".format(k, v) for k, v in timing.items()),
+        )
+
+    return result
+
+
+def record_fits(result):
+    """Adds the timing and convergence of fit results to the metrics.
+
+    Args:
+        result (dict): The results of the fits of a shot, keyed by fit name.
+    """
+    for name, v in result.items():
+        if not isinstance(v, dict):
+            metrics.increment("fits_total", fit=name, status="error")
+            continue
+        metrics.increment("fits_total", fit=name, status=v.get("status"))
+        for stage, seconds in v.get("timing", {}).items():
+            metrics.observe("fit_stage_seconds", seconds, fit=name, stage=stage)
+        if v.get("nfev") is not None:
+            metrics.observe("fit_nfev", v["nfev"], COUNT_BUCKETS, fit=name)
+        if v.get("njev") is not None:
+            metrics.observe("fit_njev", v["njev"], COUNT_BUCKETS, fit=name)
+
+
+def stored_result(result):
+    """Returns a fit result as it is stored in the database: without its timing, unless FIT_STORE_TIMING is set."""
+    if not isinstance(result, dict) or app.config.get("FIT_STORE_TIMING", False):
+        return result
+    return {k: v for k, v in result.items() if k != "timing"}
+
+
+def fit_summary(result):
+    """Returns the params, derived values and status of a fit result, or the result itself if it is an error message."""
+    if not isinstance(result, dict):
+        return result
+    return {key: result[key] for key in ("params", "derived", "status", "mode") if key in result}
+
+
+async def shot_event(data, result):
+    """Builds the server-sent event announcing a newly fit shot.
+
+    The event carries the fit results, so that clients do not have to request the shot, and the URL of a thumbnail of each fit that is rendered ahead of time into the render cache, so that loading it is a cache hit no matter how many clients do. The thumbnails are rendered with the contrast SSE_THUMBNAIL_MIN_VAL to SSE_THUMBNAIL_MAX_VAL from the app config, by default that of the client in client/; a client asking for another contrast, e.g. one fitted to the shot, renders its own.
+
+    Args:
+        data (dict): The database entry for the shot, including the new results.
+        result (dict): The results of the fits, keyed by fit name.
+
+    Returns:
+        dict: The event data, with keys "shot_id", "fits" (the summary of each fit, see fit_summary) and "thumbnails" (the URL of the thumbnail of each fit).
+    """
+    event = {"shot_id": data["_id"], "fits": {}, "thumbnails": {}}
+    width = app.config.get("SSE_THUMBNAIL_WIDTH", 300)
+    min_val = app.config.get("SSE_THUMBNAIL_MIN_VAL", -0.1)
+    max_val = app.config.get("SSE_THUMBNAIL_MAX_VAL", 1.0)
+    for k, v in result.items():
+        event["fits"][k] = fit_summary(v)
+        if not isinstance(v, dict):
+            continue
+        if width:
+            camera = data["fit"][k]["config"]["camera"]
             try:
-                write_api = influx_db.connection.write_api(write_options=SYNCHRONOUS)
-                points = [
-                    {
-                        "measurement": "fit",
-                        "tags": {"fit": k},
-                        "fields": {
-                            "N": (
-                                v["derived"]["N"]
-                                if "derived" in v and "N" in v["derived"]
-                                else None
-                            ),
-                            "sigmax_um": (
-                                v["derived"]["sigmax_um"]
-                                if "derived" in v and "sigmax_um" in v["derived"]
-                                else None
-                            ),
-                            "sigmay_um": (
-                                v["derived"]["sigmay_um"]
-                                if "derived" in v and "sigmay_um" in v["derived"]
-                                else None
-                            ),
-                            "x0_px": (
-                                v["params"]["x0"]
-                                if "params" in v and "x0" in v["params"]
-                                else None
-                            ),
-                            "y0_px": (
-                                v["params"]["y0"]
-                                if "params" in v and "y0" in v["params"]
-                                else None
-                            ),
-                        },
-                    }
-                ]
-                write_api.write(bucket="log", record=points)
-            except KeyError as e:
-                print(f"Error: {e} not found in {k} result")
+                await render_frame(data, k, camera, max_val=max_val, min_val=min_val, show_fit=True, width=width)
+            except Exception as e:
+                logger.error("Could not render thumbnail of %s: %s", k, e)
                 continue
+            query = {
+                "shot_id": data["_id"],
+                "image": k,
+                "camera": camera,
+                "min_val": min_val,
+                "max_val": max_val,
+                "show_fit": True,
+                "width": width,
+            }
+            event["thumbnails"][k] = "/frame?" + urlencode(query)
+    return event
 
-        sse_queue.append(shot_id)
 
-    return result
+@fit_bp.route("/influx")
+async def influx_stats():
+    return influx_writer.stats()
+
+
+@fit_bp.route("/metrics")
+async def metrics_endpoint():
+    """Returns the fit timing and convergence histograms and the state of the caches, queues and writers, in the Prometheus text format."""
+    caches = {"images": db.image_cache.stats(), "products": products.stats(), "shots": db.shot_cache.stats()}
+    gauges = {}
+    counters = {}
+    for stat in ("bytes", "entries"):
+        gauges["cache_" + stat] = {(("cache", k),): v[stat] for k, v in caches.items()}
+    for stat in ("hits", "misses", "evictions"):
+        counters["cache_{}_total".format(stat)] = {(("cache", k),): v[stat] for k, v in caches.items()}
+    # the numbers that only ever increase are counters, the rest gauges
+    for prefix, stats, counted in (
+        ("sse_", broadcaster.stats(), ("dropped",)),
+        ("influx_", influx_writer.stats(), ("dropped", "written", "failed_writes")),
+    ):
+        for k, v in stats.items():
+            if k in counted:
+                counters[prefix + k + "_total"] = v
+            else:
+                gauges[prefix + k] = v
+    return metrics.render(gauges, counters), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 
 @fit_bp.route("/fit")
@@ -146,3 +357,265 @@ async def fit():
 
     result = await fit_shot(shot_id, update_db)
     return result
+
+
+async def refit_batch(batch_id, query, override=None, batch_size=100):
+    """Refits every shot matching a query, writing the results back in batches.
+
+    Shots are streamed from the database with a cursor and fit concurrently on the fit executor. Results are written to MongoDB with bulk_write and to InfluxDB every batch_size shots, and a "batch" server-sent event reports progress after each write.
+
+    Args:
+        batch_id (str): An identifier for the batch, included in the progress events.
+        query (dict): The query selecting the shots to refit.
+        override (dict, optional): Fit configs that replace the stored ones, keyed by fit name. Defaults to None.
+        batch_size (int, optional): The number of shots to fit between database writes. Defaults to 100.
+    """
+    override = override or {}
+    total = await mongo.db.shots.count_documents(query)
+    progress = {"batch_id": batch_id, "total": total, "done": 0, "failed": 0}
+    updates = []
+    updated = []
+    pending = set()
+    start = monotonic()
+
+    async def fit_one(shot):
+        # past the image cache, so that a long batch does not evict the shots being looked at
+        images = await db.download_images(mongo.db, fs, shot, cache=False)
+        config = {k: v["config"] for k, v in shot.get("fit", {}).items()}
+        config.update(override)
+        result = await executor.submit(imfit.fit, images, shot, config)
+        return shot, result
+
+    def collect(tasks):
+        for task in tasks:
+            progress["done"] += 1
+            try:
+                shot, result = task.result()
+            except Exception as e:
+                progress["failed"] += 1
+                logger.error("Batch %s failed to fit a shot: %s", batch_id, e)
+                continue
+            record_fits(result)
+            update = {"fit.{}.result".format(k): stored_result(v) for k, v in result.items()}
+            update.update({"fit.{}.config".format(k): v for k, v in override.items()})
+            if update:
+                updates.append(UpdateOne({"_id": shot["_id"]}, {"$set": update}))
+                updated.append(shot["_id"])
+            influx_writer.submit(
+                influx.fit_point(k, v, influx.shot_time(shot.get("time")), influx_fields)
+                for k, v in result.items()
+                if isinstance(v, dict)
+            )
+
+    async def flush():
+        if updates:
+            try:
+                await mongo.db.shots.bulk_write(updates, ordered=False)
+            except BulkWriteError as e:
+                progress["failed"] += len(e.details.get("writeErrors", []))
+                logger.error("Batch %s failed to write %d shots: %s", batch_id, len(e.details.get("writeErrors", [])), e)
+            except PyMongoError as e:
+                progress["failed"] += len(updates)
+                logger.error("Batch %s failed to write %d shots: %s", batch_id, len(updates), e)
+            # as update_shot does, so cached shots and their ETags do not wait
+            # for the change stream; a failed write may still have applied some
+            for shot_id in updated:
+                db.invalidate_shot(shot_id)
+        updates.clear()
+        updated.clear()
+        progress["shots_per_second"] = progress["done"] / (monotonic() - start)
+        broadcaster.publish(json.dumps(progress), event="batch")
+
+    try:
+        async for shot in mongo.db.shots.find(query, FIT_PROJECTION, sort=[("time", 1)]):
+            if len(pending) >= executor.max_pending:
+                done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+                if len(updates) >= batch_size:
+                    await flush()
+            pending.add(create_task(fit_one(shot)))
+    except PyMongoError as e:
+        # report what was fit rather than leaving clients waiting for the rest
+        progress["error"] = str(e)
+        logger.error("Batch %s stopped reading shots: %s", batch_id, e)
+
+    if pending:
+        done, _ = await wait(pending)
+        collect(done)
+    await flush()
+
+
+@fit_bp.route("/fit/batch", methods=["POST"])
+async def fit_batch():
+    """Starts refitting a range of shots in the background.
+
+    Query args:
+        start, end: The first and last shots to refit, in the format YYYY_MM_DD_shotnumber.
+        date: The date whose shots to refit, in the format YYYY_MM_DD, if start is not given.
+
+    The request body may be a JSON object of fit configs, keyed by fit name, that replace the stored configs. Progress is reported as "batch" server-sent events on /sse.
+    """
+    try:
+        query = await db.shot_query(
+            mongo.db,
+            request.args.get("start", None),
+            request.args.get("end", None),
+            request.args.get("date", None),
+        )
+    except ValueError as e:
+        abort(400, str(e))
+    override = await request.get_json(silent=True)
+    if override is not None and (
+        not isinstance(override, dict) or not all(isinstance(v, dict) for v in override.values())
+    ):
+        abort(400, "The body must be a JSON object of fit configs, keyed by fit name.")
+    batch_id = uuid4().hex
+    app.add_background_task(refit_batch, batch_id, query, override)
+    return {"batch_id": batch_id}
+
+
+async def average_shots(ids, config, type="OD", concurrency=8):
+    """Averages the OD or a raw frame of many shots in constant memory.
+
+    The shots are loaded with database.load_images, at most concurrency at a time, and each frame is added to the running mean and variance as soon as it is ready, so that only a few shots are held at once. The shots and images are read past the caches, so that a long range does not evict the shots being looked at.
+
+    Args:
+        ids (iterable of str): The ids of the shots.
+        config (dict): The fit config giving the camera, region and frames, used for every shot.
+        type (str, optional): "OD", or the name of a frame in the config. Defaults to "OD".
+        concurrency (int, optional): The number of shots to load at once. Defaults to 8.
+
+    Returns:
+        (imfittre.helpers.image_process.RunningStats, dict, list of str): The mean and variance, the metadata of the images of the last shot added, and the ids of the shots that could not be added.
+    """
+    camera = config["camera"]
+    stats = ip.RunningStats()
+    metadata = None
+    failed = []
+    pending = set()
+
+    async def load(shot_id):
+        try:
+            images, shot = await db.load_images(mongo.db, fs, shot_id, camera, AVERAGE_PROJECTION, cache=False)
+            if type == "OD":
+                frame = await to_thread(ip.calculateOD, images[camera], shot["images"][camera], config)
+            else:
+                binning = shot["images"][camera]["binning"][0]
+                frame = ip.crop_frame(images[camera][config["frames"][type]], config, binning)
+            return shot_id, frame, shot["images"][camera]
+        except Exception as e:
+            logger.error("Could not load shot %s to average: %s", shot_id, e)
+            return shot_id, None, None
+
+    def collect(tasks):
+        nonlocal metadata
+        for task in tasks:
+            shot_id, frame, meta = task.result()
+            if frame is None:
+                failed.append(shot_id)
+                continue
+            try:
+                stats.add(frame)
+            except ValueError as e:
+                logger.error("Could not average shot %s: %s", shot_id, e)
+                failed.append(shot_id)
+                continue
+            metadata = meta
+
+    for shot_id in ids:
+        if len(pending) >= concurrency:
+            done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+        pending.add(create_task(load(shot_id)))
+
+    if pending:
+        done, _ = await wait(pending)
+        collect(done)
+    return stats, metadata, failed
+
+
+@fit_bp.route("/average", methods=["GET", "POST"])
+async def average():
+    """Averages the OD (or a raw frame) of many shots, e.g. repeated shots of a scan point, and optionally fits the average.
+
+    Query args:
+        start, end, date: The shots to average, as for /fit/batch, if the body does not list them.
+        image: The fit whose config gives the camera, region and frames, taken from the first shot. Defaults to "|0,0>".
+        type: "OD", or the name of a frame in the config. Defaults to "OD".
+        fit: If given, the average is fit with the config.
+        format: "array" for the mean and variance stacked into a float32 array of shape (2, height, width) packed by imfittre.helpers.codec.pack, with the rest of the response as its "metadata"; "json" for the rest of the response only; or "png" for the mean rendered as by /frame, with its max_val, min_val, cmap and width. Defaults to "array".
+        codec: The codec to compress the array with, see /array. Defaults to none.
+
+    The body may be a JSON object with "shots", a list of shot ids to average, and "config", a fit config to use instead of the stored one.
+
+    The response gives the number of shots averaged under "count", the shots that could not be averaged (e.g. because their region is a different size) under "failed", and the result of the fit, if any, under "fit".
+    """
+    body = await request.get_json(silent=True) or {}
+    image = request.args.get("image", "|0,0>")
+    type = request.args.get("type", "OD")
+    format = request.args.get("format", "array")
+    if format not in ("array", "json", "png"):
+        abort(400, 'Unknown format {}. Expecting "array", "json" or "png".'.format(format))
+
+    if "shots" in body:
+        ids = list(body["shots"])
+    else:
+        try:
+            query = await db.shot_query(
+                mongo.db,
+                request.args.get("start", None),
+                request.args.get("end", None),
+                request.args.get("date", None),
+            )
+        except ValueError as e:
+            abort(400, str(e))
+        ids = [shot["_id"] async for shot in mongo.db.shots.find(query, ["_id"], sort=[("time", 1)])]
+    if not ids:
+        abort(404, "No shots to average.")
+
+    config = body.get("config", None)
+    if config is None:
+        try:
+            first = await db.load_shot(mongo.db, ids[0], projection=["fit.{}.config".format(image)], cache=False)
+        except ValueError as e:
+            abort(400, str(e))
+        config = frame_config(first, image)
+
+    stats, metadata, failed = await average_shots(
+        ids, config, type, app.config.get("AVERAGE_CONCURRENCY", 8)
+    )
+    if stats.count == 0:
+        abort(404, "None of the shots could be averaged.")
+
+    result = None
+    if request.args.get("fit", False):
+        fits = await executor.submit(
+            imfit.fit,
+            image=None,
+            data={"images": {config["camera"]: metadata}},
+            config={image: config},
+            cropped={image: stats.mean},
+        )
+        result = stored_result(fits[image]) if isinstance(fits[image], dict) else fits[image]
+    response = {"count": stats.count, "failed": failed, "fit": result}
+
+    if format == "json":
+        return response
+    if format == "png":
+        output = ip.array_to_png(
+            stats.mean,
+            float(request.args["max_val"]) if "max_val" in request.args else None,
+            float(request.args["min_val"]) if "min_val" in request.args else None,
+            request.args.get("cmap", "inferno"),
+            int(request.args["width"]) if "width" in request.args else None,
+        )
+        return output.getvalue(), 200, {"Content-Type": "image/png"}
+    try:
+        payload = codec.pack(
+            np.stack([stats.mean, stats.variance]).astype(np.float32),
+            request.args.get("codec", None),
+            response,
+        )
+    except (ValueError, ImportError) as e:
+        abort(400, str(e))
+    return payload, 200, {"Content-Type": "application/octet-stream"}
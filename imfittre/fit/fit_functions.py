@@ -1,8 +1,98 @@
 import numpy as np
-from imfittre.fit.image_fit import Fit
+from time import perf_counter
+from imfittre.fit.image_fit import Fit, LM_STATUS_DICT, levenberg_marquardt
 
+# The fit functions, keyed by the name used for "fit_function" in fit configs
+FIT_FUNCTIONS = {}
 
+
+def register(cls):
+    """Class decorator that adds a Fit subclass to FIT_FUNCTIONS under its class name."""
+    FIT_FUNCTIONS[cls.__name__] = cls
+    return cls
+
+
+def _rotate(x, y, x0, y0, theta):
+    """Returns the coordinates relative to the center, and rotated by theta."""
+    dx = x - x0
+    dy = y - y0
+    cos = np.cos(theta)
+    sin = np.sin(theta)
+    return dx, dy, dx * cos - dy * sin, dx * sin + dy * cos
+
+
+def _thomas_fermi(xprime, yprime, Rx, Ry):
+    """The column density of a Thomas-Fermi profile with unit amplitude and radii Rx and Ry."""
+    return np.clip(1 - (xprime / Rx) ** 2 - (yprime / Ry) ** 2, 0, None) ** 1.5
+
+
+def _fit_profile(x, profile, ftol=1e-8, xtol=1e-8, max_iter=50):
+    """Fits a 1D Gaussian with an offset to a profile, starting from its moments.
+
+    With only four parameters and a few hundred points, the overhead of least_squares is much larger than the fit itself, so image_fit.levenberg_marquardt is used instead.
+
+    Args:
+        x (numpy.ndarray): The coordinates of the points of the profile, in increasing order.
+        profile (numpy.ndarray): The profile.
+        ftol (float, optional): The relative change in the cost below which the fit has converged. Defaults to 1e-8.
+        xtol (float, optional): The relative size of the step below which the fit has converged. Defaults to 1e-8.
+        max_iter (int, optional): The maximum number of iterations. Defaults to 50.
+
+    Returns:
+        (numpy.ndarray, int, int): The center, amplitude, standard deviation and offset; the status, a key of image_fit.LM_STATUS_DICT; and the number of function evaluations.
+    """
+    offset = np.median(profile)
+    weights = np.clip(profile - offset, 0, None)
+    total = weights.sum()
+    span = x[-1] - x[0] if x.size > 1 else 1
+    step = span / max(x.size - 1, 1)
+    if total > 0:
+        center = np.dot(weights, x) / total
+        sigma = np.sqrt(np.dot(weights, (x - center) ** 2) / total)
+    else:
+        center = x.mean()
+        sigma = span / 4
+    sigma = np.clip(sigma, step, span)
+    A = total * step / (np.sqrt(2 * np.pi) * sigma)
+
+    lower = np.array([x[0], 0, step / 2, -np.inf])
+    upper = np.array([x[-1], np.inf, span, np.inf])
+    p = np.clip([center, A, sigma, offset], lower, upper)[None]
+
+    # a stack of one problem, with the parameters of shape (1, 1) each
+    def residuals(p):
+        return p[:, 1:2] * np.exp(-0.5 * ((x - p[:, :1]) / p[:, 2:3]) ** 2) + p[:, 3:] - profile
+
+    def jacobian(p):
+        d = x - p[:, :1]
+        u = d / p[:, 2:3] ** 2
+        gaussian = np.exp(-0.5 * d * u)
+        return np.stack([p[:, 1:2] * gaussian * u, gaussian, p[:, 1:2] * gaussian * u * d / p[:, 2:3], np.ones_like(d)], axis=-1)
+
+    try:
+        p, status, _, nfev, _ = levenberg_marquardt(residuals, jacobian, p, lower, upper, ftol, xtol, max_iter)
+    except np.linalg.LinAlgError:
+        return p[0], -1, 1
+    return p[0], int(status[0]), nfev
+
+
+def _atom_number(integral, calibrations):
+    """Converts the integral of the OD over a cloud, in um^2, to a number of atoms, as in Gaussian.post_process."""
+    return (
+        (1 / calibrations["eff"])
+        * integral
+        * (1e-6) ** 2
+        * 4
+        * np.pi
+        / (3 * calibrations["lambda_m"] ** 2)
+    )
+
+
+@register
 class Gaussian(Fit):
+    linear = ("A", "offset", "gradx", "grady")
+    batched = True
+
     def fit_function(
         self,
         x,
@@ -35,18 +125,129 @@ class Gaussian(Fit):
         Returns:
             numpy.ndarray: The function evaluated at x and y.
         """
-        x = np.array(x)
-        y = np.array(y)
-        x = x - x0
-        y = y - y0
-        xprime = x * np.cos(theta) - y * np.sin(theta)
-        yprime = x * np.sin(theta) + y * np.cos(theta)
-        return (
-            A * np.exp(-0.5 * (xprime**2 / sigmax**2 + yprime**2 / sigmay**2))
-            + offset
-            + gradx * x
-            + grady * y
+        dx, dy, xprime, yprime, gaussian = self._components(
+            x, y, x0, y0, sigmax, sigmay, theta
+        )
+        return A * gaussian + offset + gradx * dx + grady * dy
+
+    def _components(self, x, y, x0, y0, sigmax, sigmay, theta):
+        """Computes the shifted and rotated coordinates and the unit-amplitude Gaussian.
+
+        The result of the most recent call is kept so that the Jacobian, which the solver requests at the same parameters as the preceding function evaluation, can reuse the exponential instead of recomputing it. The parameters may be arrays that broadcast against x and y, to evaluate several Gaussians at once.
+        """
+        x = np.asarray(x)
+        y = np.asarray(y)
+        # copied, since the parameters may be views of an array the solver updates in place
+        key = tuple(np.copy(p) for p in (x0, y0, sigmax, sigmay, theta))
+        cache = getattr(self, "_cache", None)
+        if (
+            cache is not None
+            and cache[0] is x
+            and cache[1] is y
+            and all(np.array_equal(a, b) for a, b in zip(cache[2], key))
+        ):
+            return cache[3]
+
+        dx, dy, xprime, yprime = _rotate(x, y, x0, y0, theta)
+        gaussian = np.exp(-0.5 * ((xprime / sigmax) ** 2 + (yprime / sigmay) ** 2))
+
+        components = (dx, dy, xprime, yprime, gaussian)
+        self._cache = (x, y, key, components)
+        return components
+
+    def jacobian(
+        self,
+        x,
+        y,
+        x0=0,
+        y0=0,
+        A=0,
+        sigmax=0,
+        sigmay=0,
+        theta=0,
+        offset=0,
+        gradx=0,
+        grady=0,
+    ):
+        """The analytic Jacobian of fit_function. See Fit.jacobian."""
+        dx, dy, xprime, yprime, gaussian = self._components(
+            x, y, x0, y0, sigmax, sigmay, theta
+        )
+        cos = np.cos(theta)
+        sin = np.sin(theta)
+        u = xprime / sigmax**2
+        v = yprime / sigmay**2
+        ag = A * gaussian
+
+        jac = np.empty(dx.shape + (9,))
+        jac[..., 0] = ag * (u * cos + v * sin) - gradx
+        jac[..., 1] = ag * (v * cos - u * sin) - grady
+        jac[..., 2] = gaussian
+        jac[..., 3] = ag * u * xprime / sigmax
+        jac[..., 4] = ag * v * yprime / sigmay
+        jac[..., 5] = ag * xprime * yprime * (1 / sigmax**2 - 1 / sigmay**2)
+        jac[..., 6] = 1
+        jac[..., 7] = dx
+        jac[..., 8] = dy
+        return jac
+
+    def basis(self, x, y, x0=0, y0=0, A=0, sigmax=0, sigmay=0, theta=0, *args):
+        """The Gaussian, the constant and the coordinates relative to the center, which A, offset, gradx and grady multiply. See Fit.basis."""
+        dx, dy, xprime, yprime, gaussian = self._components(
+            x, y, x0, y0, sigmax, sigmay, theta
         )
+        return np.stack([gaussian, np.ones_like(dx), dx, dy], axis=-1)
+
+    def fast(self):
+        """Fits 1D Gaussians to the frame summed over y and summed over x, instead of the whole frame. See Fit.fast.
+
+        The widths and centers are those of the profiles, the amplitude is the mean of the amplitudes implied by each profile, and theta and the gradients of the background are zero. Fixed parameters and bounds are ignored.
+        """
+        x, y, frame = self.axes(self.crop())
+        start = perf_counter()
+        # OD times unbinned pixels, as for GaussianProfile
+        profile_x = frame.sum(axis=0) * self.binning
+        profile_y = frame.sum(axis=1) * self.binning
+        (x0, A_x, sigmax, offset_x), status_x, nfev_x = _fit_profile(x, profile_x)
+        (y0, A_y, sigmay, offset_y), status_y, nfev_y = _fit_profile(y, profile_y)
+
+        root_2pi = np.sqrt(2 * np.pi)
+        params = {
+            "x0": x0,
+            "y0": y0,
+            "A": (A_x / (root_2pi * sigmay) + A_y / (root_2pi * sigmax)) / 2,
+            "sigmax": sigmax,
+            "sigmay": sigmay,
+            "theta": 0,
+            "offset": (offset_x / (y[-1] - y[0] + self.binning) + offset_y / (x[-1] - x[0] + self.binning)) / 2,
+            "gradx": 0,
+            "grady": 0,
+        }
+        self.result = {
+            "params": {k: float(v) for k, v in params.items()},
+            "status": LM_STATUS_DICT[min(status_x, status_y)],
+            "nfev": nfev_x + nfev_y,
+            "njev": None,
+            "cost": None,
+            "warm_start": None,
+            "mode": "fast",
+        }
+        self.timing["fast"] = perf_counter() - start
+
+    def estimate(self, x, y, frame):
+        """Estimates the center, widths and amplitude from the moments of the frame. See Fit.estimate."""
+        weights = np.clip(frame - np.median(frame), 0, None)
+        total = weights.sum()
+        if total <= 0:
+            return {}
+
+        x0 = np.dot(weights, x) / total
+        y0 = np.dot(weights, y) / total
+        sigmax = np.sqrt(np.dot(weights, (x - x0) ** 2) / total)
+        sigmay = np.sqrt(np.dot(weights, (y - y0) ** 2) / total)
+        # each pixel covers binning**2 unbinned pixels
+        A = total * self.binning**2 / (2 * np.pi * sigmax * sigmay)
+        return {"x0": x0, "y0": y0, "sigmax": sigmax, "sigmay": sigmay, "A": A}
 
     def post_process(self):
         res = self.result["params"]
@@ -72,3 +273,237 @@ class Gaussian(Fit):
         )
 
         self.result["derived"] = derived
+
+
+@register
+class ThomasFermi(Fit):
+    linear = ("A", "offset", "gradx", "grady")
+
+    def fit_function(
+        self,
+        x,
+        y,
+        x0=0,
+        y0=0,
+        A=0,
+        Rx=0,
+        Ry=0,
+        theta=0,
+        offset=0,
+        gradx=0,
+        grady=0,
+    ):
+        """The column density of a Thomas-Fermi profile, A (1 - (x/Rx)^2 - (y/Ry)^2)^(3/2), with a linear background.
+
+        Args:
+            x (numpy.ndarray): The x values at which to evaluate the function.
+            y (numpy.ndarray): The y values at which to evaluate the function.
+            x0 (float): The x coordinate of the center of the cloud.
+            y0 (float): The y coordinate of the center of the cloud.
+            A (float): The peak OD.
+            Rx (float): The Thomas-Fermi radius in the x direction.
+            Ry (float): The Thomas-Fermi radius in the y direction.
+            theta (float): The angle of the cloud in radians.
+            offset (float): The offset of the linear background.
+            gradx (float): The gradient of the linear background in the x direction.
+            grady (float): The gradient of the linear background in the y direction.
+
+        Returns:
+            numpy.ndarray: The function evaluated at x and y.
+        """
+        dx, dy, xprime, yprime = _rotate(x, y, x0, y0, theta)
+        return A * _thomas_fermi(xprime, yprime, Rx, Ry) + offset + gradx * dx + grady * dy
+
+    def basis(self, x, y, x0=0, y0=0, A=0, Rx=0, Ry=0, theta=0, *args):
+        """The Thomas-Fermi profile, the constant and the coordinates relative to the center, which A, offset, gradx and grady multiply. See Fit.basis."""
+        dx, dy, xprime, yprime = _rotate(x, y, x0, y0, theta)
+        tf = _thomas_fermi(xprime, yprime, Rx, Ry)
+        return np.stack([tf, np.ones_like(dx), dx, dy], axis=-1)
+
+    def estimate(self, x, y, frame):
+        """Estimates the center, radii and amplitude from the moments of the frame. See Fit.estimate."""
+        weights = np.clip(frame - np.median(frame), 0, None)
+        total = weights.sum()
+        if total <= 0:
+            return {}
+
+        x0 = np.dot(weights, x) / total
+        y0 = np.dot(weights, y) / total
+        # the variance of the column density along each axis is R**2 / 7
+        Rx = np.sqrt(7 * np.dot(weights, (x - x0) ** 2) / total)
+        Ry = np.sqrt(7 * np.dot(weights, (y - y0) ** 2) / total)
+        A = 5 * total * self.binning**2 / (2 * np.pi * Rx * Ry)
+        return {"x0": x0, "y0": y0, "Rx": Rx, "Ry": Ry, "A": A}
+
+    def post_process(self):
+        res = self.result["params"]
+        calibrations = self.config["calibrations"]
+        px_size = calibrations["px_size_um"]
+
+        derived = {}
+        derived["Rx_um"] = res["Rx"] * px_size
+        derived["Ry_um"] = res["Ry"] * px_size
+        derived["N"] = _atom_number(
+            2 * np.pi / 5 * res["A"] * derived["Rx_um"] * derived["Ry_um"], calibrations
+        )
+
+        self.result["derived"] = derived
+
+
+@register
+class Bimodal(Fit):
+    linear = ("A_th", "A_tf", "offset", "gradx", "grady")
+
+    def fit_function(
+        self,
+        x,
+        y,
+        x0=0,
+        y0=0,
+        A_th=0,
+        sigmax=0,
+        sigmay=0,
+        A_tf=0,
+        Rx=0,
+        Ry=0,
+        theta=0,
+        offset=0,
+        gradx=0,
+        grady=0,
+    ):
+        """A Gaussian thermal cloud and a Thomas-Fermi condensate with a common center and angle, with a linear background.
+
+        Args:
+            x (numpy.ndarray): The x values at which to evaluate the function.
+            y (numpy.ndarray): The y values at which to evaluate the function.
+            x0 (float): The x coordinate of the center of the cloud.
+            y0 (float): The y coordinate of the center of the cloud.
+            A_th (float): The amplitude of the thermal cloud.
+            sigmax (float): The standard deviation of the thermal cloud in the x direction.
+            sigmay (float): The standard deviation of the thermal cloud in the y direction.
+            A_tf (float): The peak OD of the condensate.
+            Rx (float): The Thomas-Fermi radius of the condensate in the x direction.
+            Ry (float): The Thomas-Fermi radius of the condensate in the y direction.
+            theta (float): The angle of the cloud in radians.
+            offset (float): The offset of the linear background.
+            gradx (float): The gradient of the linear background in the x direction.
+            grady (float): The gradient of the linear background in the y direction.
+
+        Returns:
+            numpy.ndarray: The function evaluated at x and y.
+        """
+        dx, dy, xprime, yprime = _rotate(x, y, x0, y0, theta)
+        thermal = np.exp(-0.5 * ((xprime / sigmax) ** 2 + (yprime / sigmay) ** 2))
+        condensate = _thomas_fermi(xprime, yprime, Rx, Ry)
+        return A_th * thermal + A_tf * condensate + offset + gradx * dx + grady * dy
+
+    def basis(self, x, y, x0=0, y0=0, A_th=0, sigmax=0, sigmay=0, A_tf=0, Rx=0, Ry=0, theta=0, *args):
+        """The thermal and condensate profiles, the constant and the coordinates relative to the center, which A_th, A_tf, offset, gradx and grady multiply. See Fit.basis."""
+        dx, dy, xprime, yprime = _rotate(x, y, x0, y0, theta)
+        thermal = np.exp(-0.5 * ((xprime / sigmax) ** 2 + (yprime / sigmay) ** 2))
+        condensate = _thomas_fermi(xprime, yprime, Rx, Ry)
+        return np.stack([thermal, condensate, np.ones_like(dx), dx, dy], axis=-1)
+
+    def post_process(self):
+        res = self.result["params"]
+        calibrations = self.config["calibrations"]
+        px_size = calibrations["px_size_um"]
+
+        derived = {}
+        derived["sigmax_um"] = res["sigmax"] * px_size
+        derived["sigmay_um"] = res["sigmay"] * px_size
+        derived["Rx_um"] = res["Rx"] * px_size
+        derived["Ry_um"] = res["Ry"] * px_size
+        derived["N_th"] = _atom_number(
+            2 * np.pi * res["A_th"] * derived["sigmax_um"] * derived["sigmay_um"], calibrations
+        )
+        derived["N_tf"] = _atom_number(
+            2 * np.pi / 5 * res["A_tf"] * derived["Rx_um"] * derived["Ry_um"], calibrations
+        )
+        derived["N"] = derived["N_th"] + derived["N_tf"]
+        derived["condensate_fraction"] = derived["N_tf"] / derived["N"] if derived["N"] else None
+
+        self.result["derived"] = derived
+
+
+@register
+class GaussianProfile(Fit):
+    """A Gaussian fit to the 1D profile of the frame along one axis, integrated over the other.
+
+    Takes the config keys of Fit, and:
+        "axis" (str): The axis of the profile, "x" or "y". Defaults to "x".
+    """
+
+    linear = ("A", "offset", "grad")
+    batched = True
+
+    def __init__(self, image, data, config, seed=None):
+        super().__init__(image, data, config, seed)
+        self.profile = config.get("axis", "x")
+        if self.profile not in ("x", "y"):
+            raise ValueError('Invalid axis {}. Expecting "x" or "y".'.format(self.profile))
+
+    def fit_function(self, x, y, center=0, A=0, sigma=0, offset=0, grad=0):
+        """A 1D Gaussian with a linear background.
+
+        Args:
+            x (numpy.ndarray): The coordinates along the profile at which to evaluate the function.
+            y: Unused.
+            center (float): The center of the Gaussian.
+            A (float): The amplitude of the Gaussian, in OD times unbinned pixels.
+            sigma (float): The standard deviation of the Gaussian.
+            offset (float): The offset of the linear background.
+            grad (float): The gradient of the linear background.
+
+        Returns:
+            numpy.ndarray: The function evaluated at x.
+        """
+        d = x - center
+        return A * np.exp(-0.5 * (d / sigma) ** 2) + offset + grad * d
+
+    def jacobian(self, x, y, center=0, A=0, sigma=0, offset=0, grad=0):
+        """The analytic Jacobian of fit_function. See Fit.jacobian."""
+        d = x - center
+        gaussian = np.exp(-0.5 * (d / sigma) ** 2)
+        u = d / sigma**2
+        ag = A * gaussian
+
+        jac = np.empty(d.shape + (5,))
+        jac[..., 0] = ag * u - grad
+        jac[..., 1] = gaussian
+        jac[..., 2] = ag * u * d / sigma
+        jac[..., 3] = 1
+        jac[..., 4] = d
+        return jac
+
+    def basis(self, x, y, center=0, A=0, sigma=0, *args):
+        """The Gaussian, the constant and the coordinate relative to the center, which A, offset and grad multiply. See Fit.basis."""
+        d = x - center
+        return np.stack([np.exp(-0.5 * (d / sigma) ** 2), np.ones_like(d), d], axis=-1)
+
+    def estimate(self, x, y, frame):
+        """Estimates the center, width and amplitude from the moments of the profile. See Fit.estimate."""
+        weights = np.clip(frame - np.median(frame), 0, None)
+        total = weights.sum()
+        if total <= 0:
+            return {}
+
+        center = np.dot(weights, x) / total
+        sigma = np.sqrt(np.dot(weights, (x - center) ** 2) / total)
+        # each point covers binning unbinned pixels along the profile
+        A = total * self.binning / (np.sqrt(2 * np.pi) * sigma)
+        return {"center": center, "sigma": sigma, "A": A}
+
+    def post_process(self):
+        res = self.result["params"]
+        calibrations = self.config["calibrations"]
+        px_size = calibrations["px_size_um"]
+
+        derived = {}
+        derived["sigma{}_um".format(self.profile)] = res["sigma"] * px_size
+        # A is in OD times unbinned pixels, so the integral is in pixels^2
+        derived["N"] = _atom_number(
+            float(np.sqrt(2 * np.pi)) * res["A"] * res["sigma"] * px_size**2, calibrations
+        )
+
+        self.result["derived"] = derived
@@ -1,10 +1,14 @@
+import logging
 import numpy as np
-from scipy.optimize import least_squares
+from time import perf_counter
+from scipy.optimize import least_squares, lsq_linear
 from inspect import signature
 from abc import ABC, abstractmethod
 
 from imfittre.helpers import image_process as ip
 
+logger = logging.getLogger(__name__)
+
 STATUS_DICT = {
     -1: "improper input parameters status returned from MINPACK",
     0: "the maximum number of function evaluations is exceeded",
@@ -14,6 +18,14 @@ STATUS_DICT = {
     4: "both ftol and xtol termination conditions are satisfied",
 }
 
+# The statuses of levenberg_marquardt, whose convergence conditions are its own
+LM_STATUS_DICT = {
+    -1: "the normal equations could not be solved",
+    0: "the maximum number of iterations is exceeded",
+    2: "the relative reduction of the cost is below ftol",
+    3: "the relative size of the step is below xtol",
+}
+
 
 class Fit(ABC):
     """Base class for fitting functions to data.
@@ -28,14 +40,46 @@ class Fit(ABC):
                 "yc" (int): The y coordinate of the center of the region.
                 "w" (int): The width of the region.
                 "h" (int): The height of the region.
-            "fit_function" (str): The name of the function to fit. Defaults to "Gaussian".
+            "fit_function" (str): The name of the function to fit, one of the keys of fit_functions.FIT_FUNCTIONS. Defaults to "Gaussian".
             "params" (dict): The parameters to use for fitting. Each key should be the name of a parameter and each value should either be a number or a list. If a number is given, the parameter is fixed to that value. If a list is given, it should be of the form [initial value, lower bound, upper bound]. This key is required.
+            "warm_start" (str): Where to take the initial values of the free parameters from instead of "params". Should be one of "previous", to use the seed (typically the result of the previous shot), or "moments", to use an estimate from the moments of the frame. If the warm-started fit fails or does not converge, the fit is repeated from "params". Defaults to None, in which case "params" is always used.
+            "joint" (bool): Whether to solve this fit together with the other joint fits of the same camera, fit function, free parameters and region size. See fit_group. Fits of functions that are not batched or have no analytic Jacobian, and fits with a pyramid or using variable projection, are always solved on their own. Defaults to False.
+            "pyramid" (list of int): Block sizes, in binned pixels, for coarse-to-fine fitting. The frame is block-averaged by each factor in turn and fit, starting from the result at the previous level, before the final fit at full resolution. Large factors should come first, e.g. [4, 2]. Defaults to [], in which case the full-resolution frame is fit directly.
+            "mode" (str): How to fit. Should be one of "full", to fit the function to the frame, "fast", to use the function's fast approximate fit instead (see fast), or "fast-then-full", to report the fast result first and then replace it with the full fit (see the stage argument of the module-level fit). Functions without a fast fit are always fit in full. Defaults to "full".
+            "variable_projection" (bool): Whether to solve for the linear parameters (see linear) exactly at each step, so that the solver only searches over the nonlinear parameters. This takes fewer iterations and does not depend on the initial values of the linear parameters. Their bounds are respected. Defaults to False.
+        seed (dict, optional): Parameter values to start from when "warm_start" is "previous". Defaults to None.
     """
 
-    def __init__(self, image, data, config):
+    # The parameters that fit_function depends on linearly, in the order of the
+    # columns returned by basis. Subclasses that implement basis should set this.
+    linear = ()
+
+    # Whether fit_function and jacobian accept stacked parameters, so that fits
+    # can be solved together by fit_group
+    batched = False
+
+    # For fits of a 1D profile of the frame, the axis of the profile, "x" or "y".
+    # See grid.
+    profile = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # the parameters of fit_function, in order, looked up once per class
+        # rather than on every fit
+        cls.parameters = tuple(
+            p for p in signature(cls.fit_function).parameters if p not in ("self", "x", "y")
+        )
+
+    def __init__(self, image, data, config, seed=None):
         self.image = image
         self.data = data
         self.config = config
+        self.warm_start = config.get("warm_start", None)
+        self.pyramid = config.get("pyramid", [])
+        self.seed = seed
+        self.projected = config.get("variable_projection", False)
+        if self.projected and not self.linear:
+            raise ValueError("{} has no linear parameters for variable projection.".format(type(self).__name__))
         self.frame = config.get("frame", "OD")
         self.region = config.get("region", None)
 
@@ -45,7 +89,10 @@ class Fit(ABC):
 
         self.binning = self.data["binning"][0]
 
+        self.cropped = None
         self.result = None
+        # the time taken by each stage of the fit, in seconds
+        self.timing = {}
 
     @abstractmethod
     def fit_function(self, x, y, **kwargs):
@@ -54,7 +101,7 @@ class Fit(ABC):
         Args:
             x (numpy.ndarray): The x values at which to evaluate the function.
             y (numpy.ndarray): The y values at which to evaluate the function.
-            **kwargs: The parameters of the function.
+            **kwargs: The parameters of the function. They are passed positionally during fitting, in the order of the signature.
 
         Returns:
             numpy.ndarray: The function evaluated at x and y.
@@ -66,43 +113,296 @@ class Fit(ABC):
         """Post-processes the fit, calculating any necessary derived values. Must be implemented in subclasses."""
         pass
 
+    def jacobian(self, x, y, **kwargs):
+        """The analytic Jacobian of the fit function. May be implemented in subclasses, in which case it is passed to the solver instead of estimating the Jacobian by finite differences.
+
+        Args:
+            x (numpy.ndarray): The flattened x values at which to evaluate the Jacobian.
+            y (numpy.ndarray): The flattened y values at which to evaluate the Jacobian.
+            **kwargs: The parameters of the function, in the same order as for fit_function.
+
+        Returns:
+            numpy.ndarray: An array of shape (x.size, number of parameters) whose columns are the derivatives of the function with respect to each parameter, in the order they appear in the signature of fit_function. If the parameters are arrays of shape (k, 1) and x and y have shape (k, x.size), as in fit_group, the Jacobians of the k functions are stacked into an array of shape (k, x.size, number of parameters).
+        """
+        raise NotImplementedError
+
+    def basis(self, x, y, **kwargs):
+        """The functions that the linear parameters multiply. Must be implemented in subclasses that set linear.
+
+        fit_function must equal the sum of the columns weighted by the linear parameters.
+
+        Args:
+            x (numpy.ndarray): The flattened x values at which to evaluate the functions.
+            y (numpy.ndarray): The flattened y values at which to evaluate the functions.
+            **kwargs: The parameters of the function, in the same order as for fit_function. Only the nonlinear parameters are used.
+
+        Returns:
+            numpy.ndarray: An array of shape (x.size, len(linear)) whose columns are the functions for each linear parameter.
+        """
+        raise NotImplementedError
+
+    def estimate(self, x, y, frame):
+        """Estimates the parameters of the fit function cheaply, for use as initial values. May be implemented in subclasses.
+
+        Args:
+            x (numpy.ndarray): The flattened x values of the frame, in unbinned pixels.
+            y (numpy.ndarray): The flattened y values of the frame, in unbinned pixels.
+            frame (numpy.ndarray): The flattened frame.
+
+        Returns:
+            dict: The estimated values of some or all of the parameters.
+        """
+        return {}
+
+    def fast(self):
+        """Fits the function approximately, in a small fraction of the time of fit, storing the result in self.result. May be implemented in subclasses.
+
+        The result must have the same params, so that it can be drawn and post-processed like the full fit, and its "mode" should be "fast".
+        """
+        raise NotImplementedError
+
+    @property
+    def has_jacobian(self):
+        """bool: Whether the subclass implements an analytic Jacobian."""
+        return type(self).jacobian is not Fit.jacobian
+
+    @property
+    def has_fast(self):
+        """bool: Whether the subclass implements a fast fit."""
+        return type(self).fast is not Fit.fast
+
     def fit(self):
-        binning = self.data["binning"][0]
+        """Fits the function to the frame, storing the result in self.result."""
+        self.prepare()
+        self.solve()
 
-        if self.frame == "OD":
-            frame = ip.calculateOD(self.image, self.data, self.config)
-        else:
-            frame = ip.crop_frame(
-                self.image[self.config["frames"][self.frame]],
-                self.config,
-                binning=binning,
-            )
+    def crop(self):
+        """Computes the frame to fit, cropped to the region, and stores it in self.cropped.
 
-        p0 = []
-        pmin = []
-        pmax = []
+        Returns:
+            numpy.ndarray: The cropped frame.
+        """
+        if self.cropped is None:
+            start = perf_counter()
+            if self.frame == "OD":
+                self.cropped = ip.calculateOD(self.image, self.data, self.config)
+            else:
+                self.cropped = ip.crop_frame(
+                    self.image[self.config["frames"][self.frame]],
+                    self.config,
+                    binning=self.binning,
+                )
+            self.timing["od"] = perf_counter() - start
+        return self.cropped
 
-        kwargs = {}
-        posargs = {}
+    def prepare(self, grids=None):
+        """Computes the frame to fit and sets up the parameters, bounds and initial values of the fit.
 
-        function_params = signature(self.fit_function).parameters
+        Args:
+            grids (dict, optional): Coordinate grids computed by other fits, which are reused if the region and binning match and to which this fit's grid is added. Defaults to None.
+        """
+        frame = self.crop()
+        start = perf_counter()
 
-        arg_idx = 0
-        for p in function_params:
-            # x and y are the coordinates at which the function is evaluated
-            if p == "x" or p == "y":
-                continue
+        names = self.parameters
+        for p in names:
             if p not in self.params:
                 raise ValueError("Parameter {} not given.".format(p))
 
-            if isinstance(self.params[p], list):
-                p0.append(self.params[p][0])
-                pmin.append(self.params[p][1])
-                pmax.append(self.params[p][2])
-                posargs[p] = arg_idx
-                arg_idx += 1
-            else:
-                kwargs[p] = self.params[p]
+        # each parameter is either a fixed value or [initial value, lower bound, upper bound]
+        specs = [self.params[p] for p in names]
+        is_free = np.array([isinstance(spec, list) for spec in specs], dtype=bool)
+        values = np.array([spec[0] if isinstance(spec, list) else spec for spec in specs], dtype=float)
+        limits = np.array([spec[1:3] for spec in specs if isinstance(spec, list)], dtype=float).reshape(-1, 2)
+
+        self.names = names
+        self.values = values
+        self.free = np.flatnonzero(is_free)
+        self.bounds = (limits[:, 0].copy(), limits[:, 1].copy())
+        self.p0 = values[self.free]
+
+        # for variable projection, the positions in free of the nonlinear
+        # parameters, the indices of the free and fixed linear parameters, and
+        # their columns in basis
+        is_linear = np.isin(names, self.linear)
+        self.nonlinear = np.flatnonzero(~is_linear[self.free])
+        self.linear_free = np.flatnonzero(is_linear & is_free)
+        self.linear_fixed = np.flatnonzero(is_linear & ~is_free)
+        self.linear_bounds = tuple(b[is_linear[self.free]] for b in self.bounds)
+        self.columns_free = [self.linear.index(names[i]) for i in self.linear_free]
+        self.columns_fixed = [self.linear.index(names[i]) for i in self.linear_fixed]
+
+        self.X, self.Y, self.target = self.grid(frame, grids=grids)
+
+        if self.warm_start == "previous":
+            seed = self.seed or {}
+        elif self.warm_start == "moments":
+            seed = self.estimate(self.X, self.Y, self.target)
+        else:
+            seed = {}
+        seed = np.array([seed.get(names[i], values[i]) for i in self.free], dtype=float)
+        if np.array_equal(seed, self.p0) or not np.all(np.isfinite(seed)):
+            self.start = None
+        else:
+            self.start = np.clip(seed, *self.bounds)
+        self.timing["prepare"] = perf_counter() - start
+
+    def residuals(self, params, X=None, Y=None, target=None):
+        """Returns the difference between the function and the frame for the given free parameters.
+
+        Args:
+            params (numpy.ndarray): The values of the free parameters.
+            X, Y, target (numpy.ndarray, optional): The grid to evaluate on, as returned by grid. Defaults to the full-resolution grid set up by prepare.
+        """
+        if X is None:
+            X, Y, target = self.X, self.Y, self.target
+        self.values[self.free] = params
+        return self.fit_function(X, Y, *self.values) - target
+
+    def residuals_jacobian(self, params, X=None, Y=None):
+        """Returns the Jacobian of residuals with respect to the free parameters. Requires has_jacobian."""
+        if X is None:
+            X, Y = self.X, self.Y
+        self.values[self.free] = params
+        return self.jacobian(X, Y, *self.values)[:, self.free]
+
+    def project(self, X, Y, target):
+        """Sets the free linear parameters to their least-squares values for the current nonlinear parameters.
+
+        Args:
+            X, Y, target (numpy.ndarray): The grid to fit, as returned by grid.
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray): The residuals, and the columns of basis for the free linear parameters.
+        """
+        columns = self.basis(X, Y, *self.values)
+        B = columns[:, self.columns_free]
+        rhs = target - columns[:, self.columns_fixed] @ self.values[self.linear_fixed]
+
+        # the normal equations are only len(linear) x len(linear)
+        coefficients = np.linalg.lstsq(B.T @ B, B.T @ rhs, rcond=None)[0]
+        lower, upper = self.linear_bounds
+        if np.any(coefficients < lower) or np.any(coefficients > upper):
+            coefficients = lsq_linear(B, rhs, bounds=(lower, upper), method="bvls").x
+        self.values[self.linear_free] = coefficients
+        return B @ coefficients - rhs, B
+
+    def solve_projected(self, X, Y, target, start):
+        """Fits by variable projection: the solver searches over the nonlinear parameters only, and the linear parameters are solved for at each step by project.
+
+        The Jacobian is Kaufman's approximation, the Jacobian of the nonlinear parameters projected onto the complement of the span of the basis.
+
+        Args:
+            X, Y, target (numpy.ndarray): The grid to fit, as returned by grid.
+            start (numpy.ndarray): The initial values of the free parameters. Those of the linear parameters are ignored.
+
+        Returns:
+            scipy.optimize.OptimizeResult: The result of least_squares, with x holding the values of all the free parameters.
+        """
+        nonlinear = self.free[self.nonlinear]
+
+        def loss(params):
+            self.values[nonlinear] = params
+            return self.project(X, Y, target)[0]
+
+        def projected_jacobian(params):
+            self.values[nonlinear] = params
+            _, B = self.project(X, Y, target)
+            J = self.jacobian(X, Y, *self.values)[:, nonlinear]
+            return J - B @ np.linalg.lstsq(B.T @ B, B.T @ J, rcond=None)[0]
+
+        jac = projected_jacobian if self.has_jacobian else "2-point"
+        bounds = (self.bounds[0][self.nonlinear], self.bounds[1][self.nonlinear])
+        result = least_squares(loss, start[self.nonlinear], jac=jac, bounds=bounds)
+        self.values[nonlinear] = result.x
+        self.project(X, Y, target)
+        result.x = self.values[self.free].copy()
+        return result
+
+    def solve(self):
+        """Runs the fit set up by prepare, storing the result in self.result."""
+        start_time = perf_counter()
+
+        def solve(X, Y, target, start):
+            if self.projected:
+                return self.solve_projected(X, Y, target, start)
+
+            def loss(params):
+                return self.residuals(params, X, Y, target)
+
+            def jacobian(params):
+                return self.residuals_jacobian(params, X, Y)
+
+            jac = jacobian if self.has_jacobian else "2-point"
+            return least_squares(loss, start, jac=jac, bounds=self.bounds)
+
+        p0 = self.p0
+        seed = self.start
+
+        # coarse-to-fine: fit block-averaged copies of the frame first, each
+        # level starting from the result of the previous one
+        start = p0 if seed is None else seed
+        nfev = 0
+        njev = 0
+        for factor in self.pyramid:
+            coarse = solve(*self.grid(self.cropped, factor), start)
+            nfev += coarse.nfev
+            njev += coarse.njev or 0
+            if coarse.status > 0:
+                start = coarse.x
+
+        result = solve(self.X, self.Y, self.target, start)
+        nfev += result.nfev
+        njev += result.njev or 0
+
+        # fall back to the configured initial values if the fit did not converge
+        if result.status <= 0 and not np.array_equal(start, p0):
+            result = solve(self.X, self.Y, self.target, p0)
+            nfev += result.nfev
+            njev += result.njev or 0
+            seed = None
+
+        self.timing["solve"] = perf_counter() - start_time
+        self.finish(result.x, result.status, nfev, seed is not None, njev, result.cost)
+
+    def finish(self, x, status, nfev, warm_started=False, njev=None, cost=None, statuses=STATUS_DICT):
+        """Stores the result of the fit in self.result.
+
+        Args:
+            x (numpy.ndarray): The fitted values of the free parameters.
+            status (int): The status returned by the solver.
+            nfev (int): The number of function evaluations.
+            warm_started (bool, optional): Whether the fit started from the warm-start values. Defaults to False.
+            njev (int, optional): The number of Jacobian evaluations. Defaults to None.
+            cost (float, optional): The final value of the cost, half the sum of the squared residuals. Defaults to None.
+            statuses (dict, optional): The messages of the statuses of the solver. Defaults to STATUS_DICT, those of least_squares.
+        """
+        if status < 0:
+            raise RuntimeError(statuses[status])
+
+        self.values[self.free] = x
+        kwargs = {p: float(v) for p, v in zip(self.names, self.values)}
+
+        self.result = {
+            "params": kwargs,
+            "status": statuses[status],
+            "nfev": int(nfev),
+            "njev": None if njev is None else int(njev),
+            "cost": None if cost is None else float(cost),
+            "warm_start": self.warm_start if warm_started else None,
+        }
+
+    def axes(self, frame, factor=1):
+        """Computes the coordinates of the columns and rows of a frame, optionally block-averaged.
+
+        Args:
+            frame (numpy.ndarray): The cropped frame.
+            factor (int, optional): The size of the blocks to average over, in binned pixels. Rows and columns that do not fill a whole block are dropped. Defaults to 1.
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): The x coordinates of the (centers of the) columns and the y coordinates of the rows, in unbinned pixels, and the block-averaged frame.
+        """
+        binning = self.binning
 
         # offset X and Y relative to the corner of the region
         # in unbinned pixels
@@ -113,60 +413,253 @@ class Fit(ABC):
             x_offset = 0
             y_offset = 0
 
+        if factor > 1:
+            h = frame.shape[0] // factor
+            w = frame.shape[1] // factor
+            frame = frame[: h * factor, : w * factor]
+            frame = frame.reshape(h, factor, w, factor).mean(axis=(1, 3))
+            x_offset += (factor - 1) * binning / 2
+            y_offset += (factor - 1) * binning / 2
+
         # in unbinned pixels
-        x = np.arange(frame.shape[1]) * binning + x_offset
-        y = np.arange(frame.shape[0]) * binning + y_offset
+        x = np.arange(frame.shape[1]) * binning * factor + x_offset
+        y = np.arange(frame.shape[0]) * binning * factor + y_offset
+        return x.astype(float), y.astype(float), frame
 
-        X, Y = np.meshgrid(x, y)
+    def grid(self, frame, factor=1, grids=None):
+        """Computes the flattened coordinates and values of a frame, optionally block-averaged.
 
-        def loss(params):
-            for p in posargs:
-                kwargs[p] = params[posargs[p]]
-            return self.fit_function(X, Y, **kwargs).flatten() - frame.flatten()
+        Args:
+            frame (numpy.ndarray): The cropped frame.
+            factor (int, optional): The size of the blocks to average over, in binned pixels. See axes. Defaults to 1.
+            grids (dict, optional): Previously computed coordinates to reuse, keyed by offset, shape and spacing. Defaults to None.
 
-        result = least_squares(loss, p0, bounds=(pmin, pmax))
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): The x and y coordinates of the (centers of the) pixels, in unbinned pixels, and the values of the pixels. For fits of a profile, the coordinates along the profile, None, and the frame summed over the other axis, times the height (or width) of a pixel in unbinned pixels.
+        """
+        x, y, frame = self.axes(frame, factor)
+        spacing = self.binning * factor
+
+        if self.profile == "x":
+            return x, None, frame.sum(axis=0) * spacing
+        if self.profile == "y":
+            return y, None, frame.sum(axis=1) * spacing
+
+        # the model is only ever evaluated on the flattened grid, so flatten
+        # the coordinates and the data once instead of on every iteration
+        key = (x[0] if x.size else 0, y[0] if y.size else 0, frame.shape, spacing)
+        if grids is not None and key in grids:
+            X, Y = grids[key]
+        else:
+            X, Y = np.meshgrid(x, y)
+            X = X.ravel()
+            Y = Y.ravel()
+            if grids is not None:
+                grids[key] = (X, Y)
+        return X, Y, frame.ravel()
 
-        if result.status < 0:
-            raise RuntimeError(STATUS_DICT[result.status])
 
-        for p in posargs:
-            kwargs[p] = result.x[posargs[p]]
+def levenberg_marquardt(residuals, jacobian, x, lower, upper, ftol=1e-8, xtol=1e-8, max_iter=100):
+    """Solves a stack of small bounded least-squares problems at once by a Levenberg-Marquardt iteration.
 
-        self.result = {"params": kwargs, "status": STATUS_DICT[result.status]}
+    The residuals, Jacobians and normal equations of all the problems are evaluated together by broadcasting, so each iteration costs about as much as one for a single problem. Parameters that the gradient pushes against a bound are held there, and the other steps are clipped to the bounds.
+
+    Args:
+        residuals (callable): Returns the residuals, of shape (k, n), of k sets of parameters, of shape (k, p).
+        jacobian (callable): Returns the Jacobians of the residuals, of shape (k, n, p), of k sets of parameters.
+        x (numpy.ndarray): The initial values of the parameters, of shape (k, p).
+        lower, upper (numpy.ndarray): The bounds of the parameters, broadcastable to the shape of x.
+        ftol (float, optional): The relative change in the cost below which a problem has converged. Defaults to 1e-8.
+        xtol (float, optional): The relative size of the step below which a problem has converged. Defaults to 1e-8.
+        max_iter (int, optional): The maximum number of iterations. Defaults to 100.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray, int, int): The parameters; the status of each problem, a key of LM_STATUS_DICT; the cost of each problem, half the sum of its squared residuals; and the numbers of evaluations of the residuals and of the Jacobian.
+
+    Raises:
+        numpy.linalg.LinAlgError: If the normal equations cannot be solved.
+    """
+    x = np.array(x, dtype=float)
+    r = residuals(x)
+    cost = 0.5 * np.einsum("kn,kn->k", r, r)
+    damping = np.full(len(x), 1e-3)
+    status = np.zeros(len(x), dtype=int)
+    nfev = 1
+    njev = 0
+    n = x.shape[1]
+
+    for _ in range(max_iter):
+        active = status == 0
+        if not active.any():
+            break
+
+        J = jacobian(x)
+        njev += 1
+        gradient = np.einsum("knp,kn->kp", J, r)
+        hessian = np.einsum("knp,knq->kpq", J, J)
+
+        # hold parameters at a bound that the gradient pushes against, so that
+        # the other parameters can still take full steps
+        held = ((x <= lower) & (gradient > 0)) | ((x >= upper) & (gradient < 0))
+        gradient[held] = 0
+        hessian *= ~held[:, :, None]
+        hessian *= ~held[:, None, :]
+        diagonal = np.einsum("kpp->kp", hessian) + held
+        # parameters the residuals do not depend on (e.g. the center when A is
+        # 0) have a zero column, so the damping needs a floor to keep the
+        # normal equations solvable
+        floor = np.maximum(1e-12 * diagonal.max(axis=1, keepdims=True), np.finfo(float).tiny)
+        hessian[:, np.arange(n), np.arange(n)] = diagonal + damping[:, None] * np.maximum(diagonal, floor)
+        step = -np.linalg.solve(hessian, gradient[..., None])[..., 0]
+        step[~active] = 0
+        trial = np.clip(x + step, lower, upper)
+
+        r_trial = residuals(trial)
+        cost_trial = 0.5 * np.einsum("kn,kn->k", r_trial, r_trial)
+        nfev += 1
+
+        improved = active & (cost_trial < cost)
+        step_norm = np.linalg.norm(trial - x, axis=1)
+        status[active & (step_norm < xtol * (xtol + np.linalg.norm(x, axis=1)))] = 3
+        status[improved & (cost - cost_trial < ftol * cost_trial) & (status == 0)] = 2
+
+        x[improved] = trial[improved]
+        r[improved] = r_trial[improved]
+        cost[improved] = cost_trial[improved]
+        damping = np.where(improved, damping / 10, damping * 10)
+
+    return x, status, cost, nfev, njev
 
 
 from imfittre.fit import fit_functions as ff
 
 
-def fit(image, data, config):
+def fit_group(fits, ftol=1e-8, xtol=1e-8, max_iter=None):
+    """Fits several prepared fits of the same function at once.
+
+    The fits are solved as a stack of small problems by levenberg_marquardt, so each iteration costs about as much as one for a single fit. Fits that do not converge are solved on their own with solve.
+
+    Args:
+        fits (list of Fit): The fits, on which prepare has been called. They must be instances of the same batched class with an analytic Jacobian, the same free parameters and the same number of pixels. Their pyramid settings are ignored.
+        ftol (float, optional): The relative change in the cost below which a fit has converged. Defaults to 1e-8.
+        xtol (float, optional): The relative size of the step below which a fit has converged. Defaults to 1e-8.
+        max_iter (int, optional): The maximum number of iterations. Defaults to None, in which case 100 times the number of free parameters is used.
+    """
+    first = fits[0]
+    free = first.free
+    values = np.stack([f.values for f in fits])
+    x = np.stack([f.p0 if f.start is None else f.start for f in fits])
+    lower = np.stack([f.bounds[0] for f in fits])
+    upper = np.stack([f.bounds[1] for f in fits])
+    X = np.stack([f.X for f in fits])
+    Y = None if first.Y is None else np.stack([f.Y for f in fits])
+    target = np.stack([f.target for f in fits])
+    if max_iter is None:
+        max_iter = 100 * len(free)
+
+    def params(x):
+        values[:, free] = x
+        return values.T[:, :, None]
+
+    def residuals(x):
+        return first.fit_function(X, Y, *params(x)) - target
+
+    def jacobian(x):
+        return first.jacobian(X, Y, *params(x))[..., free]
+
+    x, status, cost, nfev, njev = levenberg_marquardt(
+        residuals, jacobian, x, lower, upper, ftol, xtol, max_iter
+    )
+
+    for i, f in enumerate(fits):
+        if status[i] > 0:
+            f.finish(x[i], status[i], nfev, f.start is not None, njev, cost[i], LM_STATUS_DICT)
+        else:
+            f.solve()
+
+
+def fit(image, data, config, seeds=None, return_frames=False, stage=None, cropped=None):
     """Fits a given image according to the given config.
 
     Args:
         image (numpy.ndarray): The image to fit.
         data (dict): The image's metadata.
         config (dict of dict): A dictionary of fits to apply to the image where the keys are the names of the fits and the values are the configs for the fits.
+        seeds (dict of dict, optional): Parameter values to warm-start fits from, keyed by fit name. Only used by fits whose config sets "warm_start" to "previous". Defaults to None.
+        return_frames (bool, optional): If True, also returns the cropped frames that were fit, so they can be reused. Defaults to False.
+        stage (str, optional): Which fits to run, for reporting fits whose "mode" is "fast-then-full" in two stages. If "fast", only the fits whose mode is "fast" or "fast-then-full" are run, fast, except that "fast-then-full" fits without a fast mode are left to the full stage. If "full", only the fits whose mode is "full" or "fast-then-full" are run, in full. Defaults to None, in which case every fit is run, and only those whose mode is "fast" are run fast.
+        cropped (dict, optional): Cropped frames to fit instead of computing them from the image, keyed by fit name, e.g. the OD averaged over several shots. Defaults to None.
 
     Returns:
-        dict: A dictionary of fits where the keys are the names of the fits and the values are the results of the fits.
+        dict: A dictionary of fits where the keys are the names of the fits and the values are the results of the fits, including under "timing" the time in seconds taken by each stage of the fit (see Fit.timing). Fits skipped at this stage are left out. If return_frames is True, a tuple of this and a dictionary mapping the names of the fits to the cropped frames.
     """
     fits = {}
+    cropped = cropped or {}
+    frames = {}
+    prepared = {}
+    groups = {}
+    grids = {}
     for name, fit_config in config.items():
+        mode = fit_config.get("mode", "full")
+        if (stage == "fast" and mode == "full") or (stage == "full" and mode == "fast"):
+            continue
+
         # if image is a dictionary, select the correct camera
         if isinstance(image, dict):
             im = image[fit_config["camera"]]
         else:
             im = image
 
-        if fit_config["fit_function"] == "Gaussian":
-            fit_class = ff.Gaussian
-        else:
-            fit_class = None
+        fit_class = ff.FIT_FUNCTIONS.get(fit_config["fit_function"], None)
 
         if fit_class is not None:
-            f = fit_class(im, data["images"][fit_config["camera"]], fit_config)
-            f.fit()
-            f.post_process()
-            fits[name] = f.result
+            seed = seeds.get(name, None) if seeds is not None else None
+            f = fit_class(im, data["images"][fit_config["camera"]], fit_config, seed)
+            if stage == "fast" and mode == "fast-then-full" and not f.has_fast:
+                # there is no fast fit to report early; the full stage fits it
+                continue
+            f.cropped = cropped.get(name, None)
+            prepared[name] = f
+            fast = mode == "fast" or (mode == "fast-then-full" and stage == "fast")
+            if fast and f.has_fast:
+                f.fast()
+                continue
+
+            f.prepare(grids)
+            if fit_config.get("joint", False) and f.batched and f.has_jacobian and not f.pyramid and not f.projected:
+                key = (fit_config["camera"], fit_class, tuple(f.free), f.target.size)
+                groups.setdefault(key, []).append(f)
+            else:
+                f.solve()
         else:
             fits[name] = f"Fit function {fit_config['fit_function']} not recognized."
+
+    for group in groups.values():
+        if len(group) > 1:
+            start = perf_counter()
+            try:
+                fit_group(group)
+            except np.linalg.LinAlgError as e:
+                # a failed joint solve should not lose the fits of the shot
+                logger.warning("Joint fit of %d fits failed (%s); fitting them separately", len(group), e)
+                for f in group:
+                    f.solve()
+            # the fits are solved together, so each is charged for the group
+            for f in group:
+                f.timing["solve"] = perf_counter() - start
+        else:
+            group[0].solve()
+
+    for name, f in prepared.items():
+        start = perf_counter()
+        f.post_process()
+        f.timing["post_process"] = perf_counter() - start
+        f.result["timing"] = f.timing
+        fits[name] = f.result
+        frames[name] = np.ascontiguousarray(f.cropped)
+
+    # keep the order of the config
+    fits = {name: fits[name] for name in config if name in fits}
+    if return_frames:
+        return fits, frames
     return fits
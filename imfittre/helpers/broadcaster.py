@@ -0,0 +1,101 @@
+import asyncio
+import time
+from collections import deque
+
+from imfittre.helpers.server_sent_events import ServerSentEvent
+
+HEARTBEAT = b": heartbeat\r\n\r\n"
+
+
+class Broadcaster:
+    """Publishes server-sent events to every subscriber.
+
+    Each subscriber has its own bounded queue. A subscriber that falls so far behind that its queue fills up is disconnected; browsers reconnect automatically and send the id of the last event they received as the Last-Event-ID header, and the events they missed are replayed from the recent history.
+
+    Args:
+        max_queue (int, optional): The maximum number of events waiting to be sent to a subscriber. Defaults to 100.
+        history (int, optional): The number of recent events kept for replay. Defaults to 100.
+        heartbeat (float, optional): The time in seconds after which an idle subscriber is sent a comment to keep the connection alive. Defaults to 15.
+    """
+
+    def __init__(self, max_queue=100, history=100, heartbeat=15):
+        self.max_queue = max_queue
+        self.heartbeat = heartbeat
+        self.history = deque(maxlen=history)
+        self.subscribers = set()
+        self.dropped = 0
+        # ids are milliseconds since the epoch, so they keep increasing across restarts
+        self._last_id = time.time_ns() // 1_000_000
+
+    def publish(self, data, event=None):
+        """Sends an event to every subscriber.
+
+        Args:
+            data (str): The data of the event.
+            event (str, optional): The type of the event. Defaults to None.
+
+        Returns:
+            ServerSentEvent: The event.
+        """
+        self._last_id += 1
+        message = ServerSentEvent(str(data), event=event, id=self._last_id)
+        self.history.append(message)
+        for queue in list(self.subscribers):
+            if queue.full():
+                self._drop(queue)
+            else:
+                queue.put_nowait(message)
+        return message
+
+    def _drop(self, queue):
+        self.subscribers.discard(queue)
+        self.dropped += 1
+        # make room for the sentinel that tells the subscriber to disconnect
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    async def subscribe(self, last_event_id=None):
+        """Yields encoded events as they are published, starting with any recent events after last_event_id.
+
+        Args:
+            last_event_id (str or int, optional): The id of the last event the subscriber received. Defaults to None, in which case no events are replayed.
+
+        Yields:
+            bytes: The encoded events and heartbeats.
+        """
+        queue = asyncio.Queue(self.max_queue)
+        self.subscribers.add(queue)
+        try:
+            sent = -1
+            if last_event_id is not None:
+                try:
+                    sent = int(last_event_id)
+                except ValueError:
+                    pass
+                for message in list(self.history):
+                    if message.id > sent:
+                        sent = message.id
+                        yield message.encode()
+
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT
+                    continue
+                if message is None:
+                    return
+                if message.id > sent:
+                    sent = message.id
+                    yield message.encode()
+        finally:
+            self.subscribers.discard(queue)
+
+    def stats(self):
+        """Returns the number of subscribers, the deepest queue and the number of subscribers dropped for being too slow."""
+        return {
+            "subscribers": len(self.subscribers),
+            "max_queue_depth": max((q.qsize() for q in self.subscribers), default=0),
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,155 @@
+import json
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+
+import numpy as np
+
+
+def nbytes(value):
+    """Returns the approximate size of a cached value in bytes.
+
+    Args:
+        value: A numpy array, a bytes-like object, or a tuple or dict of these.
+
+    Returns:
+        int: The size in bytes.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    return 0
+
+
+class ByteLRUCache:
+    """A least-recently-used cache bounded by the total size of its values in bytes.
+
+    Values larger than the whole budget are not stored. Thread safe.
+
+    Args:
+        max_bytes (int): The maximum total size of the cached values.
+        sizeof (callable, optional): Returns the size of a value in bytes. Defaults to nbytes.
+    """
+
+    def __init__(self, max_bytes, sizeof=nbytes):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Returns the value for a key, marking it as recently used, or default if it is not cached."""
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used values until it fits.
+
+        Returns:
+            The value.
+        """
+        size = self.sizeof(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return value
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+        return value
+
+    def invalidate(self, match=None):
+        """Removes entries from the cache.
+
+        Args:
+            match (callable, optional): Removes the entries whose key it returns True for. Defaults to None, in which case every entry is removed.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        with self._lock:
+            keys = [k for k in self._entries if match is None or match(k)]
+            for k in keys:
+                self._remove(k)
+            return len(keys)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def stats(self):
+        """Returns the size and hit statistics of the cache.
+
+        Returns:
+            dict: The number of entries, the bytes used and allowed, and the numbers of hits, misses and evictions.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+        }
+
+
+def config_hash(config, keys=("frames", "region", "calibrations")):
+    """Hashes the parts of a fit config that determine a derived image.
+
+    Args:
+        config (dict): The fit config.
+        keys (tuple of str, optional): The keys of the config to hash. Defaults to the frames, region and calibrations.
+
+    Returns:
+        str: The hash.
+    """
+    subset = {k: config.get(k, None) for k in keys}
+    encoded = json.dumps(subset, sort_keys=True, default=str).encode()
+    return blake2b(encoded, digest_size=16).hexdigest()
+
+
+def product_key(kind, image_id, config, *extra):
+    """Returns the cache key of an image derived from the raw frames.
+
+    Args:
+        kind (str): The kind of product, e.g. "OD", a frame name, or "png".
+        image_id: The id of the raw image in GridFS.
+        config (dict): The fit config used to derive it.
+        *extra: Any further parameters that determine the product, e.g. render settings. Must be hashable.
+
+    Returns:
+        tuple: The key.
+    """
+    return (kind, image_id, config_hash(config)) + extra
+
+
+# Derived products (OD arrays, cropped frames and rendered PNGs), shared by the
+# fitter and the /frame route. The size is set from the app config on startup.
+products = ByteLRUCache(256 * 2**20)
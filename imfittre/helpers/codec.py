@@ -0,0 +1,173 @@
+"""Compressed storage of camera images.
+
+Images are compressed frame by frame, so that the frames of a stack can be decompressed in parallel. Each frame is optionally delta encoded (integer images only), byte shuffled so that the high and low bytes of each pixel are stored separately, and compressed. The codec is named by joining these steps with dashes, e.g. "delta-shuffle-zstd" or "shuffle-zlib", and is stored in the "codec" field of the image's fs.files document along with "frame_sizes", the compressed size of each frame. Images without a "codec" field are stored uncompressed.
+
+zlib is always available; zstd requires the zstandard package.
+
+pack and unpack wrap an array, compressed or not, in a self-describing binary payload for clients.
+"""
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# zlib and zstd release the GIL, so frames can be decompressed in threads
+_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+
+def _parse(codec):
+    steps = codec.split("-")
+    compressor = steps[-1]
+    if compressor not in ("zlib", "zstd") or any(s not in ("delta", "shuffle") for s in steps[:-1]):
+        raise ValueError("Unknown codec {}".format(codec))
+    if compressor == "zstd" and zstandard is None:
+        raise ImportError("The zstandard package is required for codec {}".format(codec))
+    return "delta" in steps, "shuffle" in steps, compressor
+
+
+def _frames(shape):
+    # a 2D image is a single frame; otherwise frames are along the first axis
+    return 1 if len(shape) < 3 else int(shape[0])
+
+
+def encode(image, codec="shuffle-zstd", level=None):
+    """Compresses an image.
+
+    Args:
+        image (numpy.ndarray): The image, either a single frame or a stack of frames along the first axis.
+        codec (str, optional): The codec to use. Defaults to "shuffle-zstd". Delta encoding only pays off for images with little shot noise.
+        level (int, optional): The compression level. Defaults to None, in which case a fast level is used.
+
+    Returns:
+        (bytes, list of int): The compressed image and the compressed size of each frame.
+    """
+    delta, shuffle, compressor = _parse(codec)
+    if delta and image.dtype.kind not in "iu":
+        raise ValueError("Delta encoding requires an integer image, got {}".format(image.dtype))
+
+    image = np.ascontiguousarray(image)
+    frames = image.reshape(_frames(image.shape), -1)
+    itemsize = image.dtype.itemsize
+
+    def encode_frame(frame):
+        if delta:
+            frame = np.diff(frame, prepend=frame.dtype.type(0))
+        data = frame.view(np.uint8)
+        if shuffle:
+            data = data.reshape(-1, itemsize).T
+        data = np.ascontiguousarray(data).tobytes()
+        if compressor == "zstd":
+            return zstandard.ZstdCompressor(level=level or 3).compress(data)
+        return zlib.compress(data, level or 1)
+
+    blobs = list(_pool.map(encode_frame, frames))
+    return b"".join(blobs), [len(b) for b in blobs]
+
+
+def decode(data, dtype, shape, codec, frame_sizes, out=None):
+    """Decompresses an image compressed with encode.
+
+    Args:
+        data (bytes-like): The compressed image.
+        dtype (str): The dtype of the image.
+        shape (list of int): The shape of the image.
+        codec (str): The codec the image was compressed with.
+        frame_sizes (list of int): The compressed size of each frame.
+        out (numpy.ndarray, optional): An array with the given shape and dtype to decompress into. Defaults to None, in which case a new array is allocated.
+
+    Returns:
+        numpy.ndarray: The image.
+    """
+    delta, shuffle, compressor = _parse(codec)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    frames = out.reshape(_frames(out.shape), -1)
+    itemsize = out.dtype.itemsize
+    if len(frame_sizes) != len(frames):
+        raise ValueError("Expected {} frames but got {}".format(len(frames), len(frame_sizes)))
+
+    data = memoryview(data)
+    offsets = np.concatenate([[0], np.cumsum(frame_sizes)]).astype(int)
+
+    def decode_frame(i):
+        blob = data[offsets[i]:offsets[i + 1]]
+        if compressor == "zstd":
+            raw = zstandard.ZstdDecompressor().decompress(blob, max_output_size=frames[i].nbytes)
+        else:
+            raw = zlib.decompress(blob)
+        raw = np.frombuffer(raw, dtype=np.uint8)
+        frame_bytes = frames[i].view(np.uint8)
+        if shuffle:
+            frame_bytes.reshape(-1, itemsize)[...] = raw.reshape(itemsize, -1).T
+        else:
+            frame_bytes[...] = raw
+        if delta:
+            np.cumsum(frames[i], dtype=frames[i].dtype, out=frames[i])
+
+    list(_pool.map(decode_frame, range(len(frames))))
+    return out
+
+
+def pack(array, codec=None, metadata=None):
+    """Packs an array into a binary payload with a header describing it.
+
+    The payload is the length of the header as a little-endian uint32, the header as UTF-8 JSON with the "dtype", "shape", "codec" and "frame_sizes" of the array (as for decode) and any "metadata", and the little-endian data, compressed with the codec if one is given. The header is padded with spaces so that the data starts at a multiple of 8 bytes, so that uncompressed data can be viewed as a typed array in place.
+
+    Args:
+        array (numpy.ndarray): The array.
+        codec (str, optional): The codec to compress the array with, e.g. "shuffle-zlib". See encode. Defaults to None, in which case the array is not compressed.
+        metadata (dict, optional): JSON-serializable data to include in the header. Defaults to None.
+
+    Returns:
+        bytes: The payload.
+    """
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+    header = {"dtype": array.dtype.str, "shape": list(array.shape), "codec": codec, "frame_sizes": None}
+    if metadata is not None:
+        header["metadata"] = metadata
+    if codec is None:
+        data = array.tobytes()
+    else:
+        data, header["frame_sizes"] = encode(array, codec)
+    header = json.dumps(header).encode()
+    header += b" " * (-(len(header) + 4) % 8)
+    return struct.pack("<I", len(header)) + header + data
+
+
+def unpack(payload):
+    """Unpacks an array packed with pack.
+
+    Args:
+        payload (bytes-like): The payload.
+
+    Returns:
+        numpy.ndarray: The array.
+    """
+    payload = memoryview(payload)
+    (length,) = struct.unpack("<I", payload[:4])
+    header = json.loads(bytes(payload[4:4 + length]))
+    data = payload[4 + length:]
+    if header["codec"] is None:
+        return np.frombuffer(data, dtype=header["dtype"]).reshape(header["shape"])
+    return decode(data, header["dtype"], header["shape"], header["codec"], header["frame_sizes"])
+
+
+def header(payload):
+    """Returns the header of a payload packed with pack, including any "metadata".
+
+    Args:
+        payload (bytes-like): The payload.
+
+    Returns:
+        dict: The header.
+    """
+    (length,) = struct.unpack("<I", payload[:4])
+    return json.loads(bytes(payload[4:4 + length]))
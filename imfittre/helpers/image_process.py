@@ -1,14 +1,16 @@
+import threading
 import numpy as np
 from scipy.optimize import least_squares
-from matplotlib import pyplot as plt
 from io import BytesIO
-from PIL import Image, ImageDraw
+from PIL import ImageDraw
+
+from . import render
 
 def crop_frame(frame, config, binning=1):
     """Crops a frame according to the given config. If no region is given, the entire frame is returned.
 
     Args:
-        frame (numpy.ndarray): The frame to crop.
+        frame (numpy.ndarray): The frame to crop. Only the last two axes are cropped, so a stack of frames may be given.
         config (dict): The config to use for cropping. Should have a dictionary with key "region" the following keys:
             xc (int): The x coordinate of the center of the crop.
             yc (int): The y coordinate of the center of the crop.
@@ -17,7 +19,7 @@ def crop_frame(frame, config, binning=1):
         binning (int, optional): The bin size of the frame. Defaults to 1.
 
     Returns:
-        numpy.ndarray: The cropped frame.
+        numpy.ndarray: The cropped frame, as a view of the original.
     """
     if "region" not in config:
         return frame
@@ -28,43 +30,151 @@ def crop_frame(frame, config, binning=1):
     h = config["region"]["h"] // binning
 
     xmin = max(0, xc-w//2)
-    xmax = min(frame.shape[1], xc+w//2)
+    xmax = min(frame.shape[-1], xc+w//2)
     ymin = max(0, yc-h//2)
-    ymax = min(frame.shape[0], yc+h//2)
+    ymax = min(frame.shape[-2], yc+h//2)
+
+    return frame[..., ymin:ymax, xmin:xmax]
+
+class ODEngine:
+    """Computes the optical density of the cropped region of a set of frames.
+
+    Only the region given by the config is read from the raw frames, which are converted to float32 as they are subtracted. The intermediate results are kept in scratch buffers that are reused between calls with the same shape, and invalid pixels are zeroed in a single pass at the end. An engine is not thread safe, so each thread should use its own.
+    """
+
+    def __init__(self):
+        self._scratch = None
+
+    def _buffers(self, shape):
+        if self._scratch is None or self._scratch[0].shape != shape:
+            self._scratch = (
+                np.empty(shape, dtype=np.float32),
+                np.empty(shape, dtype=np.float32),
+            )
+        return self._scratch
+
+    def od(self, shadow, light, dark, csat, out=None):
+        """Computes the saturation-corrected OD, -log(s1/s2) + (s2 - s1)/csat where s1 = shadow - dark and s2 = light - dark. Pixels where this is not finite are set to zero.
+
+        Args:
+            shadow (numpy.ndarray): The shadow frame(s).
+            light (numpy.ndarray): The light frame(s), with the same shape as shadow.
+            dark (numpy.ndarray): The dark frame(s), with the same shape as shadow.
+            csat (float): The effective saturation count, including binning.
+            out (numpy.ndarray, optional): A float32 array with the same shape as shadow to write the OD to. Defaults to None, in which case a new array is allocated.
+
+        Returns:
+            numpy.ndarray: The OD, as a float32 array.
+        """
+        if out is None:
+            out = np.empty(shadow.shape, dtype=np.float32)
+        s1, ratio = self._buffers(shadow.shape)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.subtract(shadow, dark, out=s1, dtype=np.float32)
+            np.subtract(light, dark, out=out, dtype=np.float32)
+            np.divide(s1, out, out=ratio)
+            np.log(ratio, out=ratio)
+            np.subtract(out, s1, out=out)
+            np.divide(out, csat, out=out)
+            np.subtract(out, ratio, out=out)
 
-    return frame[ymin:ymax, xmin:xmax]
+        # Set all nans and infs to zero
+        return np.nan_to_num(out, copy=False, nan=0, posinf=0, neginf=0)
 
-def calculateOD(image, metadata, config):
-    shadow = image[config["frames"]["shadow"]]
-    light = image[config["frames"]["light"]]
-    dark = image[config["frames"]["dark"]]
-    Ceff = config["calibrations"]["csat"]
+    def calculate(self, image, metadata, config, out=None):
+        """Computes the OD of the region of a shot given by the config.
 
-    # Note that this will only work for equal x and y binning
-    bins = metadata["binning"][0] 
+        Args:
+            image (numpy.ndarray): The frames of the shot, indexed by frame number along the first axis. A stack of shots with the frame number along the second axis may also be given, in which case the OD of each shot is computed.
+            metadata (dict): The image's metadata.
+            config (dict): The config giving the "frames", "region" and "calibrations" to use.
+            out (numpy.ndarray, optional): A float32 array to write the OD to. Defaults to None, in which case a new array is allocated.
 
-    shadowCrop = crop_frame(shadow, config, bins)
-    lightCrop = crop_frame(light, config, bins)
-    darkCrop = crop_frame(dark, config, bins)
+        Returns:
+            numpy.ndarray: The OD of the region.
+        """
+        # Note that this will only work for equal x and y binning
+        bins = metadata["binning"][0]
+        Ceff = config["calibrations"]["csat"] * bins**2
 
-    s1 = shadowCrop - darkCrop
-    s2 = lightCrop - darkCrop
-    OD = -np.log(s1/s2)
+        frames = [
+            crop_frame(image[..., config["frames"][k], :, :], config, bins)
+            for k in ("shadow", "light", "dark")
+        ]
+        return self.od(*frames, Ceff, out=out)
 
-    Ceff *= bins**2
+    def calculate_batch(self, images, metadata, config, out=None):
+        """Computes the OD of the region of many shots taken with the same camera and config.
+
+        Args:
+            images (numpy.ndarray or list of numpy.ndarray): The shots, either stacked into an array of shape (shots, frames, height, width) or as a list of arrays of shape (frames, height, width).
+            metadata (dict): The metadata shared by the images.
+            config (dict): The config giving the "frames", "region" and "calibrations" to use.
+            out (numpy.ndarray, optional): A float32 array of shape (shots, region height, region width) to write the OD to. Defaults to None.
+
+        Returns:
+            numpy.ndarray: The OD of the region of each shot.
+        """
+        if not isinstance(images, np.ndarray):
+            # only stack the frames and region that are needed
+            bins = metadata["binning"][0]
+            idx = [config["frames"][k] for k in ("shadow", "light", "dark")]
+            images = np.stack([crop_frame(im, config, bins)[idx] for im in images])
+            config = dict(config, frames={"shadow": 0, "light": 1, "dark": 2})
+            config.pop("region", None)
+        return self.calculate(images, metadata, config, out=out)
+
+
+_engines = threading.local()
+
+def calculateOD(image, metadata, config, out=None):
+    """Computes the OD of the region of a shot given by the config. See ODEngine.calculate.
+
+    Uses an ODEngine local to the calling thread, so that its scratch buffers are reused between calls.
+    """
+    engine = getattr(_engines, "engine", None)
+    if engine is None:
+        engine = _engines.engine = ODEngine()
+    return engine.calculate(image, metadata, config, out=out)
+
+class RunningStats:
+    """Accumulates the mean and variance of a sequence of frames in constant memory, with Welford's algorithm.
+
+    Frames are added one at a time, so that hundreds of shots can be averaged without holding them all. The sums are kept in float64.
+    """
 
-    ODCorrected = OD + (s2 - s1)/Ceff
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self._m2 = None
 
-    #Set all nans and infs to zero
-    ODCorrected[np.isnan(ODCorrected)] = 0
-    ODCorrected[np.isinf(ODCorrected)] = 0
+    def add(self, frame):
+        """Adds a frame.
 
-    return ODCorrected
+        Args:
+            frame (numpy.ndarray): The frame, with the same shape as the frames added before.
+        """
+        if self.mean is None:
+            self.mean = np.zeros(frame.shape)
+            self._m2 = np.zeros(frame.shape)
+        elif frame.shape != self.mean.shape:
+            raise ValueError("Expected a frame of shape {} but got {}".format(self.mean.shape, frame.shape))
+        self.count += 1
+        delta = np.subtract(frame, self.mean, dtype=np.float64)
+        self.mean += delta / self.count
+        delta *= frame - self.mean
+        self._m2 += delta
 
-from PIL import Image
+    @property
+    def variance(self):
+        """numpy.ndarray: The sample variance of each pixel, or NaN with fewer than two frames."""
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self._m2 / (self.count - 1)
 
-def array_to_png(image, max_val=None, min_val=None, cmap="inferno", width=None, height=None):
-    """Converts a numpy array to an HTML image tag.
+def array_to_png(image, max_val=None, min_val=None, cmap="inferno", width=None, height=None, format="png"):
+    """Renders a numpy array as a colormapped image. See imfittre.helpers.render.
 
     Args:
         image (numpy.ndarray): The image to convert.
@@ -73,74 +183,99 @@ def array_to_png(image, max_val=None, min_val=None, cmap="inferno", width=None,
         cmap (str, optional): The matplotlib colormap to use. Defaults to "inferno".
         width (int, optional): The width of the output image. Defaults to None.
         height (int, optional): The height of the output image. Defaults to None.
+        format (str, optional): The format of the output image, "png" or "webp". Defaults to "png".
 
     Returns:
-        str: The HTML image tag.
+        BytesIO: The encoded image.
     """
-    if max_val is None:
-        max_val = image.max()
-    if min_val is None:
-        min_val = image.min()
-    output = BytesIO()
-    plt.imsave(output, image, cmap=cmap, vmin=min_val, vmax=max_val, format='png')
-    output.seek(0)
-
-    img = Image.open(output)
-    if width is not None and height is not None:
-        img = img.resize((width, height), resample=Image.NEAREST)
-    elif width is not None:
-        img = img.resize((width, img.height * width // img.width), resample=Image.NEAREST)
-    elif height is not None:
-        img = img.resize((img.width * height // img.height, height), resample=Image.NEAREST)
-    output = BytesIO()
-    img.save(output, format='png')
-    output.seek(0)
-
-    return output
-
-def fit_to_image(fit, background=None, color="white", thickness=1):
-    """Draws an image overlay with the given fit parameters.
-
-    Draws a crosshair at params.x0, params.y0 with width params.sigmax, height params.sigmay and angle theta. The background is transparent.
-
-    The size of the image is given by config.region.w and config.region.h. The center of the image is given by config.region.xc and config.region.yc.
+    indices = render.to_indices(image, max_val, min_val, width, height)
+    return BytesIO(render.encode(indices, format, cmap))
+
+# The colors of the crosshairs of successive fits drawn over the same frame
+OVERLAY_COLORS = ("white", "cyan", "lime", "magenta", "yellow")
+
+def region_origin(config, binning=1, shape=None):
+    """Returns the corner and size of the region of a config, in unbinned pixels of the frame.
 
     Args:
-        fit (dict): The fit parameters.
-        background (BytesIO, optional): A BytesIO object containing the background image. If None, a blank image is used. Defaults to None.
-        color (str, optional): The color of the crosshair. Defaults to "white".
+        config (dict): The config, with an optional "region". See crop_frame.
+        binning (int, optional): The bin size of the frame. Defaults to 1.
+        shape (tuple, optional): The shape of the (binned) frame, used for the size when the config has no region. Defaults to None.
+
+    Returns:
+        dict: The corner "x" and "y" and the size "w" and "h" of the region.
     """
+    if "region" in config:
+        region = config["region"]
+        return {
+            "x": region["xc"] - region["w"] // 2,
+            "y": region["yc"] - region["h"] // 2,
+            "w": region["w"],
+            "h": region["h"],
+        }
+    return {"x": 0, "y": 0, "w": shape[-1] * binning, "h": shape[-2] * binning}
 
-    # Get the region information
-    xc = fit["config"]["region"]["xc"]
-    yc = fit["config"]["region"]["yc"]
-    w = fit["config"]["region"]["w"]
-    h = fit["config"]["region"]["h"]
+def fit_geometry(fit, origin=None):
+    """Returns the crosshair drawn over a fit: its center, the lengths of its two arms and its angle.
 
-    if background is None:
-        # Create a transparent image with the same size as the crop region
-        img = Image.new("RGBA", (w, h), (0, 0, 0, 0))
+    The arms are the widths sigmax and sigmay of the fit, or the radii Rx and Ry of fits without them. Fits without a 2D center, such as fits to profiles, have no crosshair.
+
+    Args:
+        fit (dict): The fit, with its "config" and "result".
+        origin (dict, optional): The corner of the region to give the center relative to, as returned by region_origin. Defaults to None, in which case the region of the fit itself is used.
+
+    Returns:
+        dict: The center "x0" and "y0" relative to the corner of the region, the arms "a" and "b" and the angle "theta", in unbinned pixels and radians, or None if the fit has no crosshair.
+    """
+    params = (fit.get("result") or {}).get("params") or {}
+    if "x0" not in params or "y0" not in params:
+        return None
+    for a, b in (("sigmax", "sigmay"), ("Rx", "Ry")):
+        if a in params and b in params:
+            break
     else:
-        # Load the background image
-        background.seek(0)
-        img = Image.open(background)
-
-    # Extract the fit parameters 
-    scale_factor = img.width / w
-    x0 = (fit["result"]["params"]["x0"] - xc + w//2) * scale_factor
-    y0 = (fit["result"]["params"]["y0"] - yc + h//2) * scale_factor
-    sigmax = fit["result"]["params"]["sigmax"] * scale_factor
-    sigmay = fit["result"]["params"]["sigmay"] * scale_factor
-    theta = fit["result"]["params"]["theta"]
-
-    # Draw the crosshair
-    draw = ImageDraw.Draw(img)
-    draw.line((x0-sigmax*np.cos(theta), y0-sigmax*np.sin(theta), x0+sigmax*np.cos(theta), y0+sigmax*np.sin(theta)), fill=color, width=int(thickness))
-    draw.line((x0-sigmay*np.sin(theta), y0+sigmay*np.cos(theta), x0+sigmay*np.sin(theta), y0-sigmay*np.cos(theta)), fill=color, width=int(thickness))
+        return None
+
+    if origin is None:
+        origin = region_origin(fit["config"])
+    return {
+        "x0": params["x0"] - origin["x"],
+        "y0": params["y0"] - origin["y"],
+        "a": params[a],
+        "b": params[b],
+        "theta": params.get("theta", 0),
+    }
+
+def draw_crosshair(draw, geometry, scale=1, color="white", thickness=1):
+    """Draws the crosshair of a fit.
+
+    Args:
+        draw (PIL.ImageDraw.ImageDraw): The drawing context of the image.
+        geometry (dict): The crosshair, as returned by fit_geometry.
+        scale (float, optional): The size of an unbinned pixel in the image. Defaults to 1.
+        color (str, optional): The color of the crosshair. Defaults to "white".
+        thickness (int, optional): The width of the lines. Defaults to 1.
+    """
+    x0 = geometry["x0"] * scale
+    y0 = geometry["y0"] * scale
+    a = geometry["a"] * scale
+    b = geometry["b"] * scale
+    cos, sin = np.cos(geometry["theta"]), np.sin(geometry["theta"])
+    draw.line((x0 - a*cos, y0 - a*sin, x0 + a*cos, y0 + a*sin), fill=color, width=int(thickness))
+    draw.line((x0 - b*sin, y0 + b*cos, x0 + b*sin, y0 - b*cos), fill=color, width=int(thickness))
 
-    # Convert the image to a png
-    output = BytesIO()
-    img.save(output, format='png')
-    output.seek(0)
+def draw_fits(img, fits, origin, thickness=1):
+    """Draws the crosshairs of several fits over an image of a region, in the colors OVERLAY_COLORS.
 
-    return output
\ No newline at end of file
+    Args:
+        img (PIL.Image.Image): The image of the region, modified in place.
+        fits (list of dict): The fits, with their "config" and "result". Fits without a crosshair are skipped.
+        origin (dict): The region, as returned by region_origin.
+        thickness (int, optional): The width of the lines. Defaults to 1.
+    """
+    draw = ImageDraw.Draw(img)
+    scale = img.width / origin["w"]
+    for i, fit in enumerate(fits):
+        geometry = fit_geometry(fit, origin)
+        if geometry is not None:
+            draw_crosshair(draw, geometry, scale, OVERLAY_COLORS[i % len(OVERLAY_COLORS)], thickness)
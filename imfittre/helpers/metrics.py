@@ -0,0 +1,140 @@
+"""Histograms and counters of where the time goes, exposed in the Prometheus text format on /metrics."""
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in seconds
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Upper bounds of the histogram buckets for counts, e.g. of function evaluations
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in sorted(labels.items()))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metrics:
+    """A registry of histograms and counters, each with any number of label sets. Thread safe.
+
+    Args:
+        prefix (str, optional): The prefix of the names of the metrics. Defaults to "imfittre_".
+    """
+
+    def __init__(self, prefix="imfittre_"):
+        self.prefix = prefix
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help):
+        """Sets the help text of a metric."""
+        self._help[name] = help
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        """Adds a value to a histogram.
+
+        Args:
+            name (str): The name of the histogram, without the prefix.
+            value (float): The value.
+            buckets (tuple of float, optional): The upper bounds of the buckets, used when the histogram is created. Defaults to TIME_BUCKETS.
+            **labels: The labels of the histogram.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key, None)
+            if histogram is None:
+                histogram = series[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def increment(self, name, amount=1, **labels):
+        """Adds to a counter.
+
+        Args:
+            name (str): The name of the counter, without the prefix.
+            amount (float, optional): The amount to add. Defaults to 1.
+            **labels: The labels of the counter.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Times the body of a with statement into a histogram of seconds.
+
+        Yields:
+            dict: A dictionary in which the elapsed time is stored under "seconds" once the body has run.
+        """
+        elapsed = {}
+        start = time.perf_counter()
+        try:
+            yield elapsed
+        finally:
+            elapsed["seconds"] = time.perf_counter() - start
+            self.observe(name, elapsed["seconds"], **labels)
+
+    def render(self, gauges=None, counters=None):
+        """Renders the metrics in the Prometheus text exposition format.
+
+        Args:
+            gauges (dict, optional): Gauges to include, mapping names (without the prefix) to either a number or a dict mapping tuples of (label, value) pairs to numbers. Values that are None are left out. Defaults to None.
+            counters (dict, optional): Counters kept elsewhere to include, e.g. the hits of a cache, in the same form as gauges. Their names should end in "_total". Defaults to None.
+
+        Returns:
+            str: The metrics.
+        """
+        lines = []
+
+        def header(name, kind):
+            full = self.prefix + name
+            if name in self._help:
+                lines.append("# HELP {} {}".format(full, self._help[name]))
+            lines.append("# TYPE {} {}".format(full, kind))
+            return full
+
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                full = header(name, "counter")
+                for key, value in series.items():
+                    lines.append("{}{} {}".format(full, _labels(dict(key)), _number(value)))
+
+            for name, series in sorted(self._histograms.items()):
+                full = header(name, "histogram")
+                for key, histogram in series.items():
+                    labels = dict(key)
+                    for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                        lines.append("{}_bucket{} {}".format(full, _labels({**labels, "le": _number(bound)}), count))
+                    lines.append("{}_bucket{} {}".format(full, _labels({**labels, "le": "+Inf"}), histogram["count"]))
+                    lines.append("{}_sum{} {}".format(full, _labels(labels), _number(histogram["sum"])))
+                    lines.append("{}_count{} {}".format(full, _labels(labels), histogram["count"]))
+
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name, value in sorted((values or {}).items()):
+                full = header(name, kind)
+                series = value if isinstance(value, dict) else {(): value}
+                for key, v in series.items():
+                    if v is not None:
+                        lines.append("{}{} {}".format(full, _labels(dict(key)), _number(v)))
+
+        return "\n".join(lines) + "\n"
+
+
+# The metrics of this server, rendered by the /metrics route
+metrics = Metrics()
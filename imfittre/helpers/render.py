@@ -0,0 +1,142 @@
+"""Rendering of arrays as colormapped images.
+
+Arrays are normalized to 8-bit indices, resized by nearest-neighbour sampling of the indices, and either encoded once with the 256-entry lookup table of the colormap as the palette, or mapped to RGB through the table when something is to be drawn on top. This gives the same pixels as matplotlib's imsave followed by a nearest-neighbour resize, without matplotlib or the intermediate encode and decode.
+"""
+import threading
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# The compression level of rendered PNGs, from 0 (none) to 9. Low levels are
+# several times faster to encode and only slightly larger for camera images.
+# Set from the app config on startup.
+png_compress_level = 1
+
+_luts = {}
+_lock = threading.Lock()
+
+
+def lut(cmap):
+    """Returns the lookup table of a matplotlib colormap, computing it on first use.
+
+    Args:
+        cmap (str): The name of the colormap.
+
+    Returns:
+        numpy.ndarray: An array of shape (256, 3) of uint8 RGB colors.
+    """
+    table = _luts.get(cmap, None)
+    if table is None:
+        # matplotlib is only needed to build the table
+        import matplotlib
+
+        colormap = matplotlib.colormaps[cmap].resampled(256)
+        table = colormap(np.arange(256), bytes=True)[:, :3].copy()
+        with _lock:
+            _luts[cmap] = table
+    return table
+
+
+def normalize(image, max_val=None, min_val=None):
+    """Maps an array to 8-bit indices into a lookup table, as matplotlib does.
+
+    Args:
+        image (numpy.ndarray): The array.
+        max_val (float, optional): The value mapped to 255. Larger values are clipped. Defaults to None, in which case the maximum of the array is used.
+        min_val (float, optional): The value mapped to 0. Smaller values are clipped. Defaults to None, in which case the minimum of the array is used.
+
+    Returns:
+        numpy.ndarray: The indices, as uint8. NaNs are mapped to 0.
+    """
+    if max_val is None:
+        max_val = np.nanmax(image)
+    if min_val is None:
+        min_val = np.nanmin(image)
+    scale = 256 / (max_val - min_val) if max_val > min_val else 0
+    indices = np.subtract(image, min_val, dtype=np.float32)
+    indices *= scale
+    np.clip(indices, 0, 255, out=indices)
+    np.nan_to_num(indices, copy=False, nan=0)
+    return indices.astype(np.uint8)
+
+
+def resize(indices, width=None, height=None):
+    """Resizes an image of indices by nearest-neighbour sampling.
+
+    Integer scale factors are applied with np.repeat, and other sizes with PIL's NEAREST filter, which is cheap on 8-bit indices.
+
+    Args:
+        indices (numpy.ndarray): The uint8 indices, as returned by normalize.
+        width (int, optional): The width of the output. Defaults to None, in which case it is scaled with the height, or left unchanged if neither is given.
+        height (int, optional): The height of the output. Defaults to None, in which case it is scaled with the width.
+
+    Returns:
+        numpy.ndarray: The resized indices.
+    """
+    h, w = indices.shape
+    if width is None and height is None:
+        return indices
+    if width is None:
+        width = w * height // h
+    elif height is None:
+        height = h * width // w
+
+    if height % h == 0 and width % w == 0:
+        return np.repeat(np.repeat(indices, height // h, axis=0), width // w, axis=1)
+    return np.asarray(Image.fromarray(indices, "L").resize((width, height), resample=Image.NEAREST))
+
+
+def to_indices(image, max_val=None, min_val=None, width=None, height=None):
+    """Normalizes and resizes an array. See normalize and resize.
+
+    Returns:
+        numpy.ndarray: The uint8 indices into the lookup table of a colormap.
+    """
+    return resize(normalize(image, max_val, min_val), width, height)
+
+
+def to_rgb(indices, cmap="inferno"):
+    """Colormaps indices with a single lookup.
+
+    Args:
+        indices (numpy.ndarray): The uint8 indices, as returned by to_indices.
+        cmap (str, optional): The matplotlib colormap to use. Defaults to "inferno".
+
+    Returns:
+        numpy.ndarray: An array of shape (height, width, 3) of uint8 RGB colors.
+    """
+    return lut(cmap).take(indices, axis=0)
+
+
+def encode(array, format="png", cmap="inferno"):
+    """Encodes an image once.
+
+    Indices are encoded as a PNG palette image with the lookup table of the colormap as the palette, which decodes to the same colors as the RGB image but is several times faster to compress and about half the size. WebP has no palette images, so indices are mapped to RGB first and encoded losslessly.
+
+    Args:
+        array (numpy.ndarray or PIL.Image.Image): Either uint8 indices of shape (height, width), uint8 colors of shape (height, width, 3 or 4), or an image, e.g. one that has been drawn on.
+        format (str, optional): "png" or "webp". Defaults to "png".
+        cmap (str, optional): The matplotlib colormap of indices. Defaults to "inferno".
+
+    Returns:
+        bytes: The encoded image.
+    """
+    if isinstance(array, Image.Image):
+        img = array
+    elif array.ndim == 2 and format != "png":
+        img = Image.fromarray(to_rgb(array, cmap), "RGB")
+    elif array.ndim == 2:
+        img = Image.fromarray(array, "P")
+        img.putpalette(lut(cmap).tobytes())
+    else:
+        img = Image.fromarray(array, "RGBA" if array.shape[2] == 4 else "RGB")
+
+    output = BytesIO()
+    if format == "png":
+        img.save(output, format="png", compress_level=png_compress_level)
+    elif format == "webp":
+        img.save(output, format="webp", lossless=True, method=0)
+    else:
+        raise ValueError('Unknown image format {}. Expecting "png" or "webp".'.format(format))
+    return output.getvalue()
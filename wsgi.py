@@ -4,7 +4,10 @@ import quart.flask_patch
 from imfittre import init_app
 from asyncio import run
 
-app = run(init_app())
+# fit worker processes re-import this module as __mp_main__ (see
+# imfittre.fit.executor.FitExecutor), and must not build an app of their own
+if __name__ != "__mp_main__":
+    app = run(init_app())
 
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    app.run()